@@ -0,0 +1,596 @@
+"""
+This module takes care of the async (ASGI) deployment mode. It serves the routes of the api Blueprint with
+the same response shapes on Quart, with async SQLAlchemy sessions and async JWT verification, reusing the
+models and helpers of the api package. Tokens are compatible with flask_jwt_extended ones, so both apps
+can run side by side on the same database. Run it with: hypercorn "api.asgi:create_async_app()"
+"""
+import os
+import uuid
+from datetime import datetime, timedelta, timezone
+from functools import wraps
+import jwt
+from flask import Flask
+from quart import Quart, Blueprint, request, jsonify, g, current_app
+from quart_cors import cors
+from sqlalchemy import and_, or_, delete, literal
+from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker
+from api.models import db, Users, Followers, Posts, Media, Comments, serialize_users, serialize_posts, dialect_insert
+from api.feed import fan_out_posts, backfill_timeline, remove_from_timeline, get_feed
+from api.pagination import parse_page_args, split_page, encode_cursor
+from api.counters import count_follows, count_posts, count_comments
+from api.trending import record_engagement
+from api.search import index_documents, post_document, comment_document
+from api.serializers import UserSerializer, PostSerializer, build_claims
+from api.cache import invalidate
+from api.entities import get_entity_cache
+
+
+api = cors(Blueprint("async_api", __name__))  # Allow CORS requests to this API
+
+
+def get_async_database_url(database_url):
+    database_url = database_url.replace("postgres://", "postgresql://", 1)
+    if database_url.startswith("postgresql://"):
+        return database_url.replace("postgresql://", "postgresql+asyncpg://", 1)
+    if database_url.startswith("sqlite://"):
+        return database_url.replace("sqlite://", "sqlite+aiosqlite://", 1)
+    return database_url
+
+
+def create_async_app(**config):
+    app = Quart(__name__)
+    app.config["SQLALCHEMY_DATABASE_URI"] = os.getenv("DATABASE_URL", "sqlite:////tmp/test.db")
+    app.config["JWT_SECRET_KEY"] = os.getenv("JWT_SECRET_KEY")
+    app.config.update(config)
+    database_url = app.config.get("ASYNC_DATABASE_URL", None) or get_async_database_url(
+        app.config["SQLALCHEMY_DATABASE_URI"])
+    engine = create_async_engine(database_url, **app.config.get("ASYNC_ENGINE_OPTIONS", {}))
+    app.extensions["async_engine"] = engine
+    app.extensions["async_session"] = async_sessionmaker(engine, expire_on_commit=False)
+    # The sync helpers of the api package read their settings from a Flask app context
+    config_app = Flask(__name__)
+    config_app.config.update(app.config)
+    app.extensions["flask_config_app"] = config_app
+    app.register_blueprint(api, url_prefix="/api")
+
+    @app.before_request
+    async def open_session():
+        g.session = app.extensions["async_session"]()
+
+    @app.teardown_request
+    async def close_session(exception=None):
+        session = g.pop("session", None)
+        if session is not None:
+            await session.close()
+
+    @app.after_serving
+    async def dispose_engine():
+        await engine.dispose()
+
+    return app
+
+
+async def run_sync(function, *args, **kwargs):
+    # Runs a sync helper on the request session, its statements still go through the async driver
+    config_app = current_app.extensions["flask_config_app"]
+
+    def call(session):
+        with config_app.app_context():
+            return function(*args, session=session, **kwargs)
+
+    return await g.session.run_sync(call)
+
+
+def invalidate_caches(resources=(), entities=()):
+    # resources and entities are (name, ids) pairs. The sync app reads the same caches when they are
+    # shared, so the async writes invalidate them after the commit too
+    with current_app.extensions["flask_config_app"].app_context():
+        for resource, resource_ids in resources:
+            invalidate(resource, *resource_ids)
+        for kind, entity_ids in entities:
+            get_entity_cache().invalidate(kind, *entity_ids)
+
+
+def create_access_token(identity, additional_claims):
+    now = datetime.now(timezone.utc)
+    payload = {"fresh": False,
+               "iat": now,
+               "jti": str(uuid.uuid4()),
+               "type": "access",
+               "sub": identity,
+               "nbf": now}
+    expires = current_app.config.get("JWT_ACCESS_TOKEN_EXPIRES", timedelta(minutes=15))
+    if expires:
+        payload["exp"] = now + expires
+    payload.update(additional_claims)
+    return jwt.encode(payload, current_app.config["JWT_SECRET_KEY"],
+                      algorithm=current_app.config.get("JWT_ALGORITHM", "HS256"))
+
+
+async def verify_jwt():
+    authorization = request.headers.get("Authorization", None)
+    if not authorization:
+        raise LookupError("Missing Authorization Header")
+    parts = authorization.split()
+    if len(parts) != 2 or parts[0] != "Bearer":
+        raise LookupError("Missing 'Bearer' type in 'Authorization' header. Expected 'Authorization: Bearer <JWT>'")
+    claims = jwt.decode(parts[1], current_app.config["JWT_SECRET_KEY"],
+                        algorithms=[current_app.config.get("JWT_ALGORITHM", "HS256")],
+                        leeway=current_app.config.get("JWT_DECODE_LEEWAY", 0))
+    if claims.get("type", None) != "access":
+        raise jwt.InvalidTokenError("Only non-refresh tokens are allowed")
+    return claims
+
+
+def jwt_required(view):
+    # Same error responses as flask_jwt_extended, the decoded claims are kept in g.jwt
+    @wraps(view)
+    async def wrapper(*args, **kwargs):
+        try:
+            g.jwt = await verify_jwt()
+        except LookupError as error:
+            return jsonify({"msg": str(error)}), 401
+        except jwt.ExpiredSignatureError:
+            return jsonify({"msg": "Token has expired"}), 401
+        except jwt.InvalidTokenError as error:
+            return jsonify({"msg": str(error)}), 422
+        return await view(*args, **kwargs)
+    return wrapper
+
+
+def get_jwt():
+    return g.jwt
+
+
+# Signup access token
+@api.route("/signup", methods=["POST"])
+async def signup():
+    response_body = {}
+    user_to_post = await request.get_json()
+    user = Users()
+    user.email = user_to_post.get("email").lower()
+    existing_user = (await g.session.execute(
+        db.select(Users).where(Users.email == user.email))).scalar()
+    if existing_user:
+        response_body["message"] = f"User {user.email} already exists"
+        response_body["results"] = None
+        return jsonify(response_body), 409
+    user.password = user_to_post.get("password")
+    user.is_active = True
+    user.is_admin = False
+    user.first_name = user_to_post.get("first_name", None)
+    user.last_name = user_to_post.get("last_name", None)
+    g.session.add(user)
+    await g.session.commit()
+    results = (await run_sync(serialize_users, [user]))[0]
+    claims = build_claims(results)
+    access_token = create_access_token(
+        identity=user.email, additional_claims=claims)
+    response_body["message"] = f"User {user.id} posted successfully"
+    response_body["results"] = results
+    response_body["access_token"] = access_token
+    return jsonify(response_body), 201
+
+
+# Login access token
+@api.route("/login", methods=["POST"])
+async def login():
+    response_body = {}
+    user_to_login = await request.get_json()
+    email = user_to_login.get("email").lower()
+    password = user_to_login.get("password")
+    user = (await g.session.execute(db.select(Users).where(Users.email == email,
+                                                           Users.password == password,
+                                                           Users.is_active == True))).scalar()
+    if not user:
+        response_body["message"] = f"Bad email or password"
+        response_body["results"] = None
+        return jsonify(response_body), 401
+    results = (await run_sync(serialize_users, [user]))[0]
+    claims = build_claims(results)
+    access_token = create_access_token(
+        identity=email, additional_claims=claims)
+    response_body["message"] = f"User {user.email} logged successfully"
+    response_body["results"] = results
+    response_body["access_token"] = access_token
+    return jsonify(response_body), 200
+
+
+@api.route("/users/<int:user_id>", methods=["GET", "PUT", "DELETE"])
+@jwt_required
+async def handle_user(user_id):
+    response_body = {}
+    claims = get_jwt()
+    token_user_id = claims["user_id"]
+    if not token_user_id:
+        response_body["message"] = "Current user not found"
+        response_body["results"] = None
+        return jsonify(response_body), 401
+    user_query = db.select(Users)
+    if request.method == "GET":
+        try:
+            serializer = UserSerializer.from_args(request.args)
+        except ValueError as error:
+            response_body["message"] = str(error)
+            response_body["results"] = None
+            return jsonify(response_body), 400
+        user_query = serializer.select()
+    user_to_handle = (await g.session.execute(user_query.where(Users.id == user_id))).scalar()
+    if not user_to_handle:
+        response_body["message"] = f"User {user_id} not found"
+        response_body["results"] = None
+        return jsonify(response_body), 404
+    if request.method == "GET":
+        results = (await run_sync(serializer.dump, [user_to_handle]))[0]
+        response_body["message"] = f"User {user_id} got successfully"
+        response_body["results"] = results
+        return jsonify(response_body), 200
+    if request.method == "PUT":
+        if token_user_id != user_to_handle.id:
+            response_body["message"] = f"User {token_user_id} is not allowed to put {user_id}"
+            response_body["results"] = None
+            return jsonify(response_body), 403
+        data = await request.get_json()
+        user_to_handle.email = data.get("email", user_to_handle.email)
+        user_to_handle.first_name = data.get("first_name", user_to_handle.first_name)
+        user_to_handle.last_name = data.get("last_name", user_to_handle.last_name)
+        await g.session.commit()
+        invalidate_caches([("user", [user_id])], [("user", [user_id])])
+        response_body["message"] = f"User {user_to_handle.id} put successfully"
+        response_body["results"] = (await run_sync(serialize_users, [user_to_handle]))[0]
+        return jsonify(response_body), 200
+    if request.method == "DELETE":
+        if token_user_id != user_to_handle.id:
+            response_body["message"] = f"User {token_user_id} is not allowed to delete {user_id}"
+            response_body["results"] = None
+            return jsonify(response_body), 403
+        user_to_handle.is_active = False
+        await g.session.commit()
+        invalidate_caches([("user", [user_id])], [("user", [user_id])])
+        response_body["message"] = f"User {user_to_handle.id} deleted successfully"
+        response_body["results"] = None
+        return jsonify(response_body), 200
+
+
+@api.route("/users/<int:user_id>/counts", methods=["GET"])
+@jwt_required
+async def handle_user_counts(user_id):
+    response_body = {}
+    claims = get_jwt()
+    token_user_id = claims["user_id"]
+    if not token_user_id:
+        response_body["message"] = "Current user not found"
+        response_body["results"] = None
+        return jsonify(response_body), 401
+    counts = (await g.session.execute(db.select(Users.follower_count,
+                                                Users.following_count,
+                                                Users.post_count).where(Users.id == user_id))).first()
+    if not counts:
+        response_body["message"] = f"User {user_id} not found"
+        response_body["results"] = None
+        return jsonify(response_body), 404
+    response_body["message"] = f"Counts of user {user_id} got successfully"
+    response_body["results"] = {"follower_count": counts.follower_count,
+                                "following_count": counts.following_count,
+                                "post_count": counts.post_count}
+    return jsonify(response_body), 200
+
+
+@api.route("/followers", methods=["GET", "POST"])
+@jwt_required
+async def handle_followers():
+    response_body = {}
+    claims = get_jwt()
+    token_user_id = claims["user_id"]
+    if not token_user_id:
+        response_body["message"] = "Current user not found"
+        response_body["results"] = None
+        return jsonify(response_body), 401
+    if request.method == "GET":
+        try:
+            limit, cursor = parse_page_args(request.args, current_app.config,
+                                            "followers", "following", partial=True)
+        except ValueError:
+            response_body["message"] = "Invalid pagination parameters"
+            response_body["results"] = None
+            return jsonify(response_body), 400
+        next_cursor = {}
+        followers = []
+        following = []
+        if not cursor or "followers" in cursor:
+            followers_query = (db.select(Followers).where(Followers.following_id == token_user_id)
+                               .order_by(Followers.follower_id).limit(limit + 1))
+            if cursor:
+                followers_query = followers_query.where(Followers.follower_id > cursor["followers"])
+            followers, last = split_page((await g.session.execute(followers_query)).scalars().all(), limit)
+            if last:
+                next_cursor["followers"] = last.follower_id
+        if not cursor or "following" in cursor:
+            following_query = (db.select(Followers).where(Followers.follower_id == token_user_id)
+                               .order_by(Followers.following_id).limit(limit + 1))
+            if cursor:
+                following_query = following_query.where(Followers.following_id > cursor["following"])
+            following, last = split_page((await g.session.execute(following_query)).scalars().all(), limit)
+            if last:
+                next_cursor["following"] = last.following_id
+        response_body["next_cursor"] = encode_cursor(next_cursor)
+        following_results = [row.serialize() for row in following]
+        followers_results = [row.serialize() for row in followers]
+        if not followers and not following:
+            response_body["message"] = f"User {token_user_id} does not follow or is followed by anyone"
+        elif not followers:
+            response_body["message"] = f"Users followed by user {token_user_id} got successfully"
+        elif not following:
+            response_body["message"] = f"Followers of user {token_user_id} got successfully"
+        else:
+            response_body["message"] = f"Followers and followed by user {token_user_id} got successfully"
+        response_body["results"] = {"following": following_results,
+                                    "followers": followers_results}
+        return jsonify(response_body), 200
+    if request.method == "POST":
+        data = await request.get_json()
+        following_id = data.get("following_id", None)
+        follow_target = db.select(literal(token_user_id), Users.id).where(Users.id == following_id)
+        follower = (await g.session.execute(
+            dialect_insert(Followers, g.session.sync_session)
+            .from_select(["follower_id", "following_id"], follow_target)
+            .on_conflict_do_nothing(index_elements=["follower_id", "following_id"])
+            .returning(Followers.id, Followers.following_id, Followers.follower_id))).first()
+        if not follower:
+            follow_exists = (await g.session.execute(
+                db.select(Users.id).where(Users.id == following_id))).scalar()
+            if not follow_exists:
+                response_body["message"] = f"User {following_id} not found"
+                response_body["results"] = None
+                return jsonify(response_body), 404
+            response_body["message"] = f"User {token_user_id} is already following {following_id}"
+            response_body["results"] = None
+            return jsonify(response_body), 409
+        await run_sync(backfill_timeline, token_user_id, [following_id])
+        await run_sync(count_follows, token_user_id, [following_id])
+        await g.session.commit()
+        invalidate_caches([("user", [token_user_id, following_id])])
+        results = {"id": follower.id,
+                   "following_id": follower.following_id,
+                   "follower_id": follower.follower_id}
+        response_body["message"] = f"User {token_user_id} now follows user {following_id}"
+        response_body["results"] = results
+        return jsonify(response_body), 201
+
+
+@api.route("/followers/<int:following_id>", methods=["DELETE"])
+@jwt_required
+async def handle_follower(following_id):
+    response_body = {}
+    claims = get_jwt()
+    token_user_id = claims["user_id"]
+    if not token_user_id:
+        response_body["message"] = "Current user not found"
+        response_body["results"] = None
+        return jsonify(response_body), 404
+    if request.method == "DELETE":
+        following_user = (await g.session.execute(
+            delete(Followers)
+            .where(Followers.follower_id == token_user_id,
+                   Followers.following_id == following_id)
+            .returning(Followers.id))).first()
+        if not following_user:
+            response_body["message"] = f"Following user {following_id} not found"
+            response_body["results"] = None
+            return jsonify(response_body), 404
+        await run_sync(remove_from_timeline, token_user_id, following_id)
+        await run_sync(count_follows, token_user_id, [following_id], delta=-1)
+        await g.session.commit()
+        invalidate_caches([("user", [token_user_id, following_id])])
+        response_body["message"] = f"Following user {following_id} deleted successfully"
+        response_body["results"] = None
+        return jsonify(response_body), 200
+
+
+@api.route("/posts", methods=["GET", "POST"])
+@jwt_required
+async def handle_posts():
+    response_body = {}
+    claims = get_jwt()
+    token_user_id = claims["user_id"]
+    if not token_user_id:
+        response_body["message"] = "Current user not found"
+        response_body["results"] = None
+        return jsonify(response_body), 401
+    if request.method == "GET":
+        try:
+            limit, cursor = parse_page_args(request.args, current_app.config, "date", "id")
+        except ValueError:
+            response_body["message"] = "Invalid pagination parameters"
+            response_body["results"] = None
+            return jsonify(response_body), 400
+        try:
+            serializer = PostSerializer.from_args(
+                request.args, comments_limit=current_app.config.get("POSTS_COMMENTS_PREVIEW", 3))
+        except ValueError as error:
+            response_body["message"] = str(error)
+            response_body["results"] = None
+            return jsonify(response_body), 400
+        posts_query = (serializer.select().where(Posts.user_id == token_user_id)
+                       .order_by(Posts.date.desc(), Posts.id.desc()).limit(limit + 1))
+        if cursor:
+            posts_query = posts_query.where(or_(
+                Posts.date < cursor["date"],
+                and_(Posts.date == cursor["date"], Posts.id < cursor["id"])))
+        posts, last = split_page((await g.session.execute(posts_query)).scalars().all(), limit)
+        response_body["next_cursor"] = encode_cursor({"date": last.date, "id": last.id} if last else None)
+        if not posts:
+            response_body["message"] = f"User {token_user_id} has not posted anything yet"
+            response_body["results"] = []
+            return jsonify(response_body), 200
+        results = await run_sync(serializer.dump, posts)
+        response_body["message"] = f"Posts from user {token_user_id} got successfully"
+        response_body["results"] = results
+        return jsonify(response_body), 200
+    if request.method == "POST":
+        data = await request.get_json()
+        post = Posts()
+        post.title = data.get("title", None)
+        post.description = data.get("description", None)
+        post.body = data.get("body", None)
+        post.date = datetime.now().date()
+        post.user_id = token_user_id
+        g.session.add(post)
+        await g.session.flush()
+        await run_sync(fan_out_posts, [post.id])
+        await run_sync(count_posts, token_user_id, 1)
+        await run_sync(index_documents, [post_document(post.id, post.title, post.description, post.body)])
+        await g.session.commit()
+        invalidate_caches([("user", [token_user_id])], [("post", [post.id])])
+        results = (await run_sync(serialize_posts, [post]))[0]
+        response_body["message"] = f"User {token_user_id} posted a new post"
+        response_body["results"] = results
+        return jsonify(response_body), 201
+
+
+@api.route("/feed", methods=["GET"])
+@jwt_required
+async def handle_feed():
+    response_body = {}
+    claims = get_jwt()
+    token_user_id = claims["user_id"]
+    if not token_user_id:
+        response_body["message"] = "Current user not found"
+        response_body["results"] = None
+        return jsonify(response_body), 401
+    try:
+        limit, cursor = parse_page_args(request.args, current_app.config, "date", "id")
+    except ValueError:
+        response_body["message"] = "Invalid pagination parameters"
+        response_body["results"] = None
+        return jsonify(response_body), 400
+    try:
+        serializer = PostSerializer.from_args(
+            request.args, comments_limit=current_app.config.get("POSTS_COMMENTS_PREVIEW", 3))
+    except ValueError as error:
+        response_body["message"] = str(error)
+        response_body["results"] = None
+        return jsonify(response_body), 400
+    posts, next_cursor = await run_sync(get_feed, token_user_id, limit, cursor, serializer.select())
+    response_body["next_cursor"] = encode_cursor(next_cursor)
+    if not posts:
+        response_body["message"] = f"Feed of user {token_user_id} is empty"
+        response_body["results"] = []
+        return jsonify(response_body), 200
+    results = await run_sync(serializer.dump, posts)
+    response_body["message"] = f"Feed of user {token_user_id} got successfully"
+    response_body["results"] = results
+    return jsonify(response_body), 200
+
+
+@api.route("/posts/<int:post_id>/comments", methods=["GET", "POST"])
+@jwt_required
+async def handle_comments(post_id):
+    response_body = {}
+    claims = get_jwt()
+    token_user_id = claims["user_id"]
+    if not token_user_id:
+        response_body["message"] = "Current user not found"
+        response_body["results"] = None
+        return jsonify(response_body), 401
+    post_exists = (await g.session.execute(
+        db.select(Posts).where(Posts.id == post_id))).scalar()
+    if not post_exists:
+        response_body["message"] = f"Post {post_id} not found"
+        response_body["results"] = None
+        return jsonify(response_body), 404
+    if request.method == "GET":
+        try:
+            limit, cursor = parse_page_args(request.args, current_app.config, "id")
+        except ValueError:
+            response_body["message"] = "Invalid pagination parameters"
+            response_body["results"] = None
+            return jsonify(response_body), 400
+        comments_query = (db.select(Comments).where(Comments.post_id == post_id)
+                          .order_by(Comments.id).limit(limit + 1))
+        if cursor:
+            comments_query = comments_query.where(Comments.id > cursor["id"])
+        comments, last = split_page((await g.session.execute(comments_query)).scalars().all(), limit)
+        response_body["next_cursor"] = encode_cursor({"id": last.id} if last else None)
+        if not comments:
+            response_body["message"] = f"There are no comments in post {post_id}"
+            response_body["results"] = []
+            return jsonify(response_body), 200
+        results = [row.serialize() for row in comments]
+        response_body["message"] = f"Comments from post {post_id} got successfully"
+        response_body["results"] = results
+        return jsonify(response_body), 200
+    if request.method == "POST":
+        data = await request.get_json()
+        comment = Comments()
+        comment.body = data.get("body", None)
+        comment.user_id = token_user_id
+        comment.post_id = post_id
+        g.session.add(comment)
+        await g.session.flush()
+        await run_sync(count_comments, [post_id])
+        await run_sync(record_engagement, [post_id], "comments")
+        await run_sync(index_documents, [comment_document(comment.id, post_id, comment.body)])
+        await g.session.commit()
+        invalidate_caches([("comments", [post_id]), ("user", [token_user_id])])
+        results = comment.serialize()
+        response_body["message"] = f"User {token_user_id} posted a new comment in post {post_id}"
+        response_body["results"] = results
+        return jsonify(response_body), 201
+
+
+@api.route("/posts/<int:post_id>/media", methods=["GET", "POST"])
+@jwt_required
+async def handle_media(post_id):
+    response_body = {}
+    claims = get_jwt()
+    token_user_id = claims["user_id"]
+    if not token_user_id:
+        response_body["message"] = "Current user not found"
+        response_body["results"] = None
+        return jsonify(response_body), 401
+    post_exists = (await g.session.execute(
+        db.select(Posts).where(Posts.id == post_id))).scalar()
+    if not post_exists:
+        response_body["message"] = f"Post {post_id} not found"
+        response_body["results"] = None
+        return jsonify(response_body), 404
+    if request.method == "GET":
+        medium = (await g.session.execute(db.select(Media).where(
+            Media.post_id == post_id))).scalar()
+        if not medium:
+            response_body["message"] = f"There is no medium in post {post_id}"
+            response_body["results"] = None
+            return jsonify(response_body), 404
+        results = medium.serialize()
+        response_body["message"] = f"Medium from post {post_id} got successfully"
+        response_body["results"] = results
+        return jsonify(response_body), 200
+    if request.method == "POST":
+        if post_exists.user_id != token_user_id:
+            response_body["message"] = f"User {token_user_id} is not allowed to add a medium to post {post_id}"
+            response_body["results"] = None
+            return jsonify(response_body), 403
+        data = await request.get_json()
+        medium_type = data.get("medium_type", None)
+        if medium_type not in ["image", "video", "audio"]:
+            response_body["message"] = f"Invalid medium_type: {medium_type}"
+            response_body["results"] = None
+            return jsonify(response_body), 400
+        url = data.get("url", None)
+        if not url:
+            response_body["message"] = f"Error in adding medium to post {post_id}"
+            response_body["results"] = None
+            return jsonify(response_body), 400
+        medium = Media()
+        medium.url = url
+        medium.medium_type = medium_type
+        medium.post_id = post_id
+        g.session.add(medium)
+        await run_sync(record_engagement, [post_id], "media")
+        await g.session.commit()
+        invalidate_caches([("media", [post_id])])
+        results = medium.serialize()
+        response_body["message"] = f"User {token_user_id} added a new medium to post {post_id}"
+        response_body["results"] = results
+        return jsonify(response_body), 201
@@ -0,0 +1,70 @@
+"""
+This module takes care of multiplexing many API calls in one POST /batch request. Sub-requests run
+in-process against the api Blueprint views and share the database session. They carry the Authorization
+header of the batch, which each view checks with its own jwt_required like for any other request.
+With parallel enabled, consecutive GET sub-requests run together in worker threads
+"""
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlsplit
+from flask import current_app, request
+from werkzeug.exceptions import HTTPException
+from api.models import db
+
+
+# Sub-requests cannot log in or open another batch, and the export streams are not JSON
+EXCLUDED_ENDPOINTS = ("api.signup", "api.login", "api.handle_batch", "api.handle_user_export")
+
+
+def run_subrequest(app, sub_request, headers):
+    if not isinstance(sub_request, dict) or not isinstance(sub_request.get("path", None), str):
+        return {"status": 400, "body": {"message": "Sub-request must have a path", "results": None}}
+    method = str(sub_request.get("method", "GET")).upper()
+    path = sub_request["path"]
+    body = sub_request.get("body", None)
+    with app.test_request_context(path, method=method, json=body, headers=headers):
+        try:
+            endpoint, view_args = app.create_url_adapter(request).match(urlsplit(path).path, method=method)
+        except HTTPException as error:
+            return {"status": error.code, "body": {"message": error.description, "results": None}}
+        if not endpoint.startswith("api.") or endpoint in EXCLUDED_ENDPOINTS:
+            return {"status": 400, "body": {"message": f"{method} {path} is not allowed in a batch", "results": None}}
+        view = app.view_functions[endpoint]
+        try:
+            response = app.make_response(view(**view_args))
+        except HTTPException as error:
+            return {"status": error.code, "body": {"message": error.description, "results": None}}
+        except Exception:
+            db.session.rollback()
+            app.logger.exception("Sub-request %s %s failed", method, path)
+            return {"status": 500, "body": {"message": f"{method} {path} failed", "results": None}}
+        return {"status": response.status_code, "body": response.get_json(silent=True)}
+
+
+def run_parallel_subrequest(app, sub_request, headers):
+    # Every thread has its own app context, so its own database session
+    with app.app_context():
+        return run_subrequest(app, sub_request, headers)
+
+
+def run_batch(sub_requests, parallel=False):
+    app = current_app._get_current_object()
+    headers = {"Authorization": request.headers.get("Authorization", "")}
+    if not parallel:
+        return [run_subrequest(app, sub_request, headers) for sub_request in sub_requests]
+    # Writes keep their order and act as barriers, the GETs between two writes run at the same time
+    results = []
+    reads = []
+    with ThreadPoolExecutor(max_workers=app.config.get("BATCH_PARALLEL_WORKERS", 4)) as executor:
+
+        def run_reads():
+            results.extend(executor.map(lambda read: run_parallel_subrequest(app, read, headers), reads))
+            reads.clear()
+
+        for sub_request in sub_requests:
+            if isinstance(sub_request, dict) and str(sub_request.get("method", "GET")).upper() == "GET":
+                reads.append(sub_request)
+                continue
+            run_reads()
+            results.append(run_subrequest(app, sub_request, headers))
+        run_reads()
+    return results
@@ -0,0 +1,350 @@
+"""
+This module takes care of benchmarking the API: it builds an app around the api Blueprint, seeds a
+synthetic social graph and drives every route, reporting throughput, latency percentiles, SQL
+statements per request and the cost of every response encoder as JSON.
+Run it with: python -m api.benchmark --database-url sqlite:///bench.db
+"""
+import argparse
+import itertools
+import json
+import math
+import platform
+import random
+import time
+from datetime import date, timedelta
+from flask import Flask
+from flask.json.provider import DefaultJSONProvider
+from flask_jwt_extended import JWTManager
+from sqlalchemy import event, insert
+from api.models import db, Users, Followers, Posts, Media, Comments, serialize_users, serialize_posts
+from api.routes import api
+from api.feed import fan_out_posts
+from api.counters import reconcile_counters
+from api.search import reindex_all
+from api import encoders
+
+
+def create_app(database_url, **config):
+    app = Flask(__name__)
+    app.config["SQLALCHEMY_DATABASE_URI"] = database_url
+    app.config["JWT_SECRET_KEY"] = "benchmark-secret"
+    app.config["JWT_ACCESS_TOKEN_EXPIRES"] = False
+    app.config.update(config)
+    JWTManager(app)
+    db.init_app(app)
+    app.register_blueprint(api, url_prefix="/api")
+    return app
+
+
+def bulk_insert(model, rows, chunk_size=5000, returning=False):
+    # executemany inserts in chunks. With returning, the new ids come back in the order of rows, the model
+    # needs an insert sentinel for that to stay a single statement per chunk
+    ids = []
+    statement = insert(model).returning(model.id, sort_by_parameter_order=True) if returning else insert(model)
+    for start in range(0, len(rows), chunk_size):
+        result = db.session.execute(statement, rows[start:start + chunk_size])
+        if returning:
+            ids.extend(result.scalars())
+    return ids
+
+
+def seed(args, rnd):
+    # Followed users are drawn from a power-law so a few accounts concentrate most of the followers
+    users = [{"email": f"user{number}@bench.local",
+              "password": "bench",
+              "is_active": True,
+              "is_admin": number == 1,
+              "first_name": f"First{number}",
+              "last_name": f"Last{number}"} for number in range(1, args.users + 1)]
+    bulk_insert(Users, users)
+    # Emails are unique, so they give the ids back without ordering the RETURNING rows
+    emails = dict(db.session.execute(db.select(Users.id, Users.email)).all())
+    user_ids = sorted(emails)
+    weights = [1 / rank ** args.alpha for rank in range(1, args.users + 1)]
+    follows = []
+    for user_id in user_ids:
+        targets = set(rnd.choices(user_ids, weights=weights, k=args.following))
+        targets.discard(user_id)
+        follows.extend({"follower_id": user_id, "following_id": target} for target in sorted(targets))
+    bulk_insert(Followers, follows)
+    today = date.today()
+    posts = []
+    for user_id in user_ids:
+        for _ in range(rnd.randint(0, 2 * args.posts)):
+            posts.append({"title": f"Post {len(posts) + 1}",
+                          "description": "Benchmark post",
+                          "body": "lorem ipsum " * rnd.randint(1, 40),
+                          "date": today - timedelta(days=rnd.randint(0, 365)),
+                          "user_id": user_id})
+    for post_id, post in zip(bulk_insert(Posts, posts, returning=True), posts):
+        post["id"] = post_id
+    comments = []
+    for post in posts:
+        for _ in range(rnd.randint(0, 2 * args.comments)):
+            comments.append({"body": "nice " * rnd.randint(1, 10),
+                             "user_id": rnd.choice(user_ids),
+                             "post_id": post["id"]})
+    bulk_insert(Comments, comments)
+    media = [{"medium_type": rnd.choice(["image", "video", "audio"]),
+              "url": f"https://media.bench.local/{post['id']}",
+              "post_id": post["id"]} for post in posts if rnd.random() < args.media_ratio]
+    bulk_insert(Media, media)
+    db.session.commit()
+    # The follower counts decide who is a celebrity, so they must be right before the fan out
+    reconcile_counters()
+    post_ids = [post["id"] for post in posts]
+    for start in range(0, len(post_ids), 1000):
+        fan_out_posts(post_ids[start:start + 1000])
+    db.session.commit()
+    reindex_all()
+    with_media = {medium["post_id"] for medium in media}
+    return {"users": user_ids,
+            "emails": emails,
+            "follows": [(row["follower_id"], row["following_id"]) for row in follows],
+            "posts": [(post["id"], post["user_id"]) for post in posts],
+            "posts_without_media": [(post["id"], post["user_id"]) for post in posts
+                                    if post["id"] not in with_media],
+            "counts": {"users": len(users), "follows": len(follows), "posts": len(posts),
+                       "comments": len(comments), "media": len(media)}}
+
+
+def build_scenarios(graph, rnd):
+    # Each scenario returns (method, path, json, user_id) for one request, user_id None means anonymous
+    users = graph["users"]
+    follows = list(graph["follows"])
+    rnd.shuffle(follows)
+    posts = graph["posts"]
+    posts_without_media = list(graph["posts_without_media"])
+    signups = itertools.count(1)
+    # The admin is never deactivated, and every deactivated user is a different one
+    deletable = list(users[1:])
+    rnd.shuffle(deletable)
+
+    def put_user():
+        user_id = rnd.choice(users)
+        return "PUT", f"/api/users/{user_id}", {"first_name": f"Renamed{user_id}"}, user_id
+
+    def unfollow():
+        follower_id, following_id = follows.pop() if follows else (rnd.choice(users), rnd.choice(users))
+        return "DELETE", f"/api/followers/{following_id}", None, follower_id
+
+    def delete_user():
+        user_id = deletable.pop() if deletable else rnd.choice(users[1:])
+        return "DELETE", f"/api/users/{user_id}", None, user_id
+
+    def export_account():
+        user_id = rnd.choice(users)
+        return "GET", f"/api/users/{user_id}/export", None, user_id
+
+    def batch():
+        return "POST", "/api/batch", {"parallel": True, "requests": [
+            {"method": "GET", "path": f"/api/users/{rnd.choice(users)}"},
+            {"method": "GET", "path": f"/api/posts/{rnd.choice(posts)[0]}/comments"},
+            {"method": "GET", "path": "/api/feed"},
+            {"method": "GET", "path": "/api/followers/suggestions"}]}, rnd.choice(users)
+
+    def add_medium():
+        post_id, user_id = posts_without_media.pop() if posts_without_media else rnd.choice(posts)
+        return "POST", f"/api/posts/{post_id}/media", {"medium_type": "image",
+                                                       "url": f"https://media.bench.local/new/{post_id}"}, user_id
+
+    return {
+        "POST /signup": ({200, 201}, lambda: (
+            "POST", "/api/signup", {"email": f"new{next(signups)}@bench.local", "password": "bench"}, None)),
+        "POST /login": ({200}, lambda: (
+            "POST", "/api/login", {"email": graph["emails"][rnd.choice(users)], "password": "bench"}, None)),
+        "GET /users/<id>": ({200}, lambda: ("GET", f"/api/users/{rnd.choice(users)}", None, rnd.choice(users))),
+        "PUT /users/<id>": ({200}, put_user),
+        "GET /users/<id>/counts": ({200}, lambda: (
+            "GET", f"/api/users/{rnd.choice(users)}/counts", None, rnd.choice(users))),
+        "GET /followers": ({200}, lambda: ("GET", "/api/followers", None, rnd.choice(users))),
+        "POST /followers": ({201, 409}, lambda: (
+            "POST", "/api/followers", {"following_id": rnd.choice(users)}, rnd.choice(users))),
+        "POST /followers/batch": ({200}, lambda: (
+            "POST", "/api/followers/batch",
+            {"items": [{"following_id": rnd.choice(users)} for _ in range(50)]}, rnd.choice(users))),
+        "DELETE /followers/<id>": ({200, 404}, unfollow),
+        "GET /posts": ({200}, lambda: ("GET", "/api/posts", None, rnd.choice(users))),
+        "POST /posts": ({201}, lambda: (
+            "POST", "/api/posts", {"title": "Bench", "description": "Bench", "body": "Bench post"},
+            rnd.choice(users))),
+        "POST /posts/batch": ({200}, lambda: (
+            "POST", "/api/posts/batch",
+            {"items": [{"title": "Bench", "body": "Bench post"} for _ in range(50)]}, rnd.choice(users))),
+        "GET /feed": ({200}, lambda: ("GET", "/api/feed", None, rnd.choice(users))),
+        "GET /posts/trending": ({200}, lambda: ("GET", "/api/posts/trending", None, rnd.choice(users))),
+        "GET /posts/<id>/comments": ({200}, lambda: (
+            "GET", f"/api/posts/{rnd.choice(posts)[0]}/comments", None, rnd.choice(users))),
+        "POST /posts/<id>/comments": ({201}, lambda: (
+            "POST", f"/api/posts/{rnd.choice(posts)[0]}/comments", {"body": "Bench comment"}, rnd.choice(users))),
+        "POST /comments/batch": ({200}, lambda: (
+            "POST", "/api/comments/batch",
+            {"items": [{"post_id": rnd.choice(posts)[0], "body": "Bench comment"} for _ in range(50)]},
+            rnd.choice(users))),
+        "GET /posts/<id>/media": ({200, 404}, lambda: (
+            "GET", f"/api/posts/{rnd.choice(posts)[0]}/media", None, rnd.choice(users))),
+        "POST /posts/<id>/media": ({201}, add_medium),
+        "GET /followers/mutual": ({200}, lambda: ("GET", "/api/followers/mutual", None, rnd.choice(users))),
+        "POST /followers/check": ({200}, lambda: (
+            "POST", "/api/followers/check",
+            {"items": [{"follower_id": rnd.choice(users), "following_id": rnd.choice(users)} for _ in range(50)]},
+            rnd.choice(users))),
+        "GET /followers/suggestions": ({200}, lambda: (
+            "GET", "/api/followers/suggestions", None, rnd.choice(users))),
+        "GET /users/<id>/export": ({200}, export_account),
+        "GET /search": ({200}, lambda: (
+            "GET", f"/api/search?q={rnd.choice(['lorem', 'ipsum', 'nice', 'bench post'])}", None,
+            rnd.choice(users))),
+        "POST /batch": ({200}, batch),
+        # Without SQL_INSTRUMENTATION the stats answer 404, the request is still measured
+        "GET /admin/stats": ({200, 404}, lambda: ("GET", "/api/admin/stats", None, users[0])),
+        "GET /admin/pools": ({200}, lambda: ("GET", "/api/admin/pools", None, users[0])),
+        "GET /admin/entity-cache": ({200}, lambda: ("GET", "/api/admin/entity-cache", None, users[0])),
+        # Last, so the users it deactivates are not needed to log in by the other scenarios
+        "DELETE /users/<id>": ({200}, delete_user)}
+
+
+def percentile(latencies, value):
+    if not latencies:
+        return None
+    index = max(math.ceil(value / 100 * len(latencies)) - 1, 0)
+    return round(latencies[index] * 1000, 3)
+
+
+def get_token(client, graph, tokens, user_id):
+    # Users log in through the API the first time they are used, outside of the measured request
+    if user_id not in tokens:
+        response = client.post("/api/login", json={"email": graph["emails"][user_id], "password": "bench"})
+        tokens[user_id] = response.get_json()["access_token"]
+    return tokens[user_id]
+
+
+def run_scenario(client, graph, tokens, expected, make_request, requests_count, statements):
+    latencies = []
+    statement_counts = []
+    errors = 0
+    started = time.perf_counter()
+    for _ in range(requests_count):
+        method, path, body, user_id = make_request()
+        headers = {"Authorization": f"Bearer {get_token(client, graph, tokens, user_id)}"} if user_id else {}
+        statements[0] = 0
+        request_started = time.perf_counter()
+        response = client.open(path, method=method, json=body, headers=headers)
+        # Streamed responses like the exports are only produced while their body is read
+        response.get_data()
+        latencies.append(time.perf_counter() - request_started)
+        statement_counts.append(statements[0])
+        if response.status_code not in expected:
+            errors += 1
+    elapsed = time.perf_counter() - started
+    latencies.sort()
+    return {"requests": requests_count,
+            "errors": errors,
+            "throughput_rps": round(requests_count / elapsed, 2) if elapsed else None,
+            "p50_ms": percentile(latencies, 50),
+            "p95_ms": percentile(latencies, 95),
+            "p99_ms": percentile(latencies, 99),
+            "statements_per_request": round(sum(statement_counts) / len(statement_counts), 2)}
+
+
+def benchmark_encoders(app, iterations):
+    # Encodes pages of serialized users and posts with the jsonify provider and every installed encoder,
+    # then compresses each encoding, reporting milliseconds per payload and bytes
+    users = db.session.execute(db.select(Users).order_by(Users.id).limit(100)).scalars().all()
+    posts = db.session.execute(db.select(Posts).order_by(Posts.id).limit(100)).scalars().all()
+    payloads = {"users": {"message": "Users got successfully", "results": serialize_users(users)},
+                "posts": {"message": "Posts got successfully",
+                          "results": serialize_posts(posts, app.config.get("POSTS_COMMENTS_PREVIEW", 3))}}
+    provider = DefaultJSONProvider(app)
+    provider.compact = True
+    encoder_functions = {"jsonify": lambda payload: provider.dumps(payload).encode()}
+    if encoders.orjson:
+        encoder_functions["orjson"] = lambda payload: encoders.encode_json(payload, provider.default)
+    if encoders.msgpack:
+        encoder_functions["msgpack"] = lambda payload: encoders.encode_msgpack(payload, provider.default)
+    results = {}
+    for payload_name, payload in payloads.items():
+        for encoder_name, encode in encoder_functions.items():
+            body = encode(payload)
+            started = time.perf_counter()
+            for _ in range(iterations):
+                encode(payload)
+            results.setdefault(payload_name, {})[encoder_name] = {
+                "ms": round((time.perf_counter() - started) / iterations * 1000, 3),
+                "bytes": len(body)}
+            for encoding, compress in encoders.COMPRESSORS.items():
+                started = time.perf_counter()
+                for _ in range(iterations):
+                    compressed = compress(body)
+                results[payload_name][f"{encoder_name}+{encoding}"] = {
+                    "ms": round((time.perf_counter() - started) / iterations * 1000, 3),
+                    "bytes": len(compressed)}
+    return results
+
+
+def run(args):
+    rnd = random.Random(args.seed)
+    app = create_app(args.database_url, FEED_CELEBRITY_THRESHOLD=args.celebrity_threshold)
+    report = {"python": platform.python_version(),
+              "database_url": args.database_url,
+              "parameters": {"users": args.users, "following": args.following, "alpha": args.alpha,
+                             "posts": args.posts, "comments": args.comments, "media_ratio": args.media_ratio,
+                             "requests": args.requests, "seed": args.seed,
+                             "celebrity_threshold": args.celebrity_threshold,
+                             "encoder_iterations": args.encoder_iterations},
+              "routes": {}}
+    with app.app_context():
+        db.drop_all()
+        db.create_all()
+        seed_started = time.perf_counter()
+        graph = seed(args, rnd)
+        report["dialect"] = db.engine.dialect.name
+        report["seed"] = {"seconds": round(time.perf_counter() - seed_started, 3), **graph["counts"]}
+        statements = [0]
+
+        def count_statement(*event_args):
+            statements[0] += 1
+
+        event.listen(db.engine, "before_cursor_execute", count_statement)
+        client = app.test_client()
+        tokens = {}
+        scenarios = build_scenarios(graph, rnd)
+        for name, (expected, make_request) in scenarios.items():
+            if args.routes and name not in args.routes:
+                continue
+            report["routes"][name] = run_scenario(client, graph, tokens, expected, make_request,
+                                                  args.requests, statements)
+        event.remove(db.engine, "before_cursor_execute", count_statement)
+        if args.encoder_iterations:
+            report["encoders"] = benchmark_encoders(app, args.encoder_iterations)
+    return report
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark every route of the api Blueprint")
+    parser.add_argument("--database-url", default="sqlite:///benchmark.db")
+    parser.add_argument("--users", type=int, default=1000)
+    parser.add_argument("--following", type=int, default=50, help="follows drawn per user before dedup")
+    parser.add_argument("--alpha", type=float, default=1.1, help="power-law exponent of the followed users")
+    parser.add_argument("--posts", type=int, default=10, help="average posts per user")
+    parser.add_argument("--comments", type=int, default=3, help="average comments per post")
+    parser.add_argument("--media-ratio", type=float, default=0.6)
+    parser.add_argument("--celebrity-threshold", type=int, default=200,
+                        help="followers above which posts are merged at read time instead of fanned out")
+    parser.add_argument("--requests", type=int, default=200, help="requests per route")
+    parser.add_argument("--routes", nargs="*", help="only run these routes, e.g. \"GET /feed\"")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--encoder-iterations", type=int, default=100,
+                        help="encodings per payload in the encoder benchmark, 0 skips it")
+    parser.add_argument("--output", help="write the JSON report to this file instead of stdout")
+    args = parser.parse_args(argv)
+    report = json.dumps(run(args), indent=2)
+    if args.output:
+        with open(args.output, "w") as output:
+            output.write(report)
+    else:
+        print(report)
+
+
+if __name__ == "__main__":
+    main()
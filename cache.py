@@ -0,0 +1,137 @@
+"""
+This module takes care of the HTTP response cache of the api Blueprint. GET responses are stored per
+resource (e.g. "user:1") with a strong ETag, and the write paths invalidate the resources they change.
+Set RESPONSE_CACHE_BACKEND to "lru", "redis" or a backend instance to enable it
+"""
+import hashlib
+import pickle
+import threading
+import time
+from collections import OrderedDict
+from functools import wraps
+from flask import current_app, request, make_response, g
+from api.encoders import negotiate_media_type
+
+
+class LRUBackend:
+    # In-process backend, every worker keeps its own entries so invalidations only reach that worker
+
+    def __init__(self, max_entries=1024, ttl=300):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.tags = {}
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key, None)
+            if not entry:
+                return None
+            expires_at, tag, value = entry
+            if expires_at < time.monotonic():
+                self._remove(key)
+                return None
+            self.entries.move_to_end(key)
+            return value
+
+    def set(self, key, value, tag):
+        with self.lock:
+            self._remove(key)
+            self.entries[key] = (time.monotonic() + self.ttl, tag, value)
+            self.tags.setdefault(tag, set()).add(key)
+            while len(self.entries) > self.max_entries:
+                self._remove(next(iter(self.entries)))
+
+    def invalidate(self, tag):
+        with self.lock:
+            for key in list(self.tags.get(tag, ())):
+                self._remove(key)
+
+    def _remove(self, key):
+        entry = self.entries.pop(key, None)
+        if not entry:
+            return
+        keys = self.tags.get(entry[1], None)
+        if keys is not None:
+            keys.discard(key)
+            if not keys:
+                del self.tags[entry[1]]
+
+
+class RedisBackend:
+    # Shared backend, all workers see the same entries and invalidations. Needs the redis package
+
+    def __init__(self, url, ttl=300, prefix="api-cache:"):
+        import redis
+        self.client = redis.Redis.from_url(url)
+        self.ttl = ttl
+        self.prefix = prefix
+
+    def get(self, key):
+        value = self.client.get(self.prefix + key)
+        return pickle.loads(value) if value is not None else None
+
+    def set(self, key, value, tag):
+        pipeline = self.client.pipeline()
+        pipeline.set(self.prefix + key, pickle.dumps(value), ex=self.ttl)
+        pipeline.sadd(self.prefix + "tag:" + tag, self.prefix + key)
+        pipeline.expire(self.prefix + "tag:" + tag, self.ttl)
+        pipeline.execute()
+
+    def invalidate(self, tag):
+        tag_key = self.prefix + "tag:" + tag
+        keys = self.client.smembers(tag_key)
+        self.client.delete(tag_key, *keys)
+
+
+def get_cache():
+    if "response_cache" not in current_app.extensions:
+        backend = current_app.config.get("RESPONSE_CACHE_BACKEND", None)
+        ttl = current_app.config.get("RESPONSE_CACHE_TTL", 300)
+        if backend == "lru":
+            backend = LRUBackend(current_app.config.get("RESPONSE_CACHE_MAX_ENTRIES", 1024), ttl)
+        elif backend == "redis":
+            backend = RedisBackend(current_app.config["RESPONSE_CACHE_REDIS_URL"], ttl)
+        current_app.extensions["response_cache"] = backend
+    return current_app.extensions["response_cache"]
+
+
+def invalidate(resource, *resource_ids):
+    # Call it after the commit, otherwise a concurrent read could cache the old rows again
+    backend = get_cache()
+    if backend is None:
+        return
+    for resource_id in set(resource_ids):
+        backend.invalidate(f"{resource}:{resource_id}")
+
+
+def cached(resource, id_arg):
+    # Caches successful GET responses of a view under the resource named by its id_arg view argument
+    def decorator(view):
+        @wraps(view)
+        def wrapper(*args, **kwargs):
+            backend = get_cache()
+            if backend is None or request.method != "GET":
+                return view(*args, **kwargs)
+            tag = f"{resource}:{kwargs[id_arg]}"
+            # MessagePack and JSON bodies of the same path are different entries, compression happens later
+            key = f"{tag}:{negotiate_media_type()}:{request.full_path}"
+            entry = backend.get(key)
+            if entry is None:
+                response = make_response(view(*args, **kwargs))
+                # A replica may lag behind the primary, caching what it answered would hide the last writes
+                # from their own writers, who read from the primary (see api.replicas)
+                if response.status_code != 200 or g.get("db_replica", None):
+                    return response
+                body = response.get_data()
+                entry = {"etag": hashlib.sha256(body).hexdigest(),
+                         "body": body,
+                         "mimetype": response.mimetype}
+                backend.set(key, entry, tag)
+            response = current_app.response_class(entry["body"], status=200, mimetype=entry["mimetype"])
+            response.set_etag(entry["etag"])
+            response.headers["Cache-Control"] = "private, no-cache"
+            return response.make_conditional(request)
+        return wrapper
+    return decorator
@@ -0,0 +1,44 @@
+"""
+This module takes care of the Flask CLI commands, they run maintenance tasks outside of the API
+but still integrated with the database. Register them with setup_commands(app)
+"""
+import click
+from api.counters import reconcile_counters
+from api.export import iter_account_records, iter_ndjson, iter_gzip
+from api.search import reindex_all
+from api.trending import prune_engagement
+
+
+def setup_commands(app):
+
+    @app.cli.command("reconcile-counters")
+    def reconcile_counters_command():
+        print("Rebuilding follower, following, post and comment counters")
+        reconcile_counters()
+        print("Counters rebuilt")
+
+    @app.cli.command("export-account")
+    @click.argument("user_id", type=int)
+    @click.option("--output", required=True, help="File to write the NDJSON export to")
+    @click.option("--gzip", "compress", is_flag=True, help="Compress the export with gzip")
+    def export_account_command(user_id, output, compress):
+        chunks = iter_ndjson(iter_account_records(user_id))
+        if compress:
+            chunks = iter_gzip(chunks)
+        with open(output, "wb") as export_file:
+            for chunk in chunks:
+                export_file.write(chunk)
+        print(f"Account {user_id} exported to {output}")
+
+    @app.cli.command("reindex-search")
+    @click.option("--batch-size", default=1000, help="Documents indexed per statement")
+    def reindex_search_command(batch_size):
+        print("Rebuilding the search index from posts and comments")
+        reindex_all(batch_size)
+        print("Search index rebuilt")
+
+    @app.cli.command("prune-trending")
+    def prune_trending_command():
+        print("Deleting engagement buckets out of the trending window")
+        deleted = prune_engagement()
+        print(f"{deleted} engagement buckets deleted")
@@ -0,0 +1,51 @@
+"""
+This module takes care of the denormalized counters in Users and Posts, they are updated in the same
+transaction as the writes that change them and can be rebuilt from the source tables
+"""
+from collections import Counter
+from sqlalchemy import update, bindparam, func
+from api.models import db, Users, Followers, Posts, Comments
+
+
+def increment_counters(model, column, deltas, session=None):
+    # deltas maps ids to increments, all of them are applied with one executemany UPDATE
+    session = session if session is not None else db.session
+    table = model.__table__
+    params = [{"counter_id": counter_id, "delta": delta} for counter_id, delta in deltas.items() if delta]
+    if not params:
+        return
+    statement = (update(table)
+                 .where(table.c.id == bindparam("counter_id"))
+                 .values({column: table.c[column] + bindparam("delta")}))
+    session.connection().execute(statement, params)
+
+
+def count_follows(follower_id, following_ids, delta=1, session=None):
+    following_ids = Counter(following_ids)
+    increment_counters(Users, "following_count", {follower_id: delta * sum(following_ids.values())}, session)
+    increment_counters(Users, "follower_count", {following_id: delta * count
+                                                 for following_id, count in following_ids.items()}, session)
+
+
+def count_posts(user_id, total, delta=1, session=None):
+    increment_counters(Users, "post_count", {user_id: delta * total}, session)
+
+
+def count_comments(post_ids, delta=1, session=None):
+    increment_counters(Posts, "comment_count", {post_id: delta * count
+                                                for post_id, count in Counter(post_ids).items()}, session)
+
+
+def reconcile_counters():
+    # One correlated UPDATE per table rebuilds every counter from the source rows
+    db.session.execute(update(Users).values(
+        follower_count=db.select(func.count(Followers.id))
+        .where(Followers.following_id == Users.id).scalar_subquery(),
+        following_count=db.select(func.count(Followers.id))
+        .where(Followers.follower_id == Users.id).scalar_subquery(),
+        post_count=db.select(func.count(Posts.id))
+        .where(Posts.user_id == Users.id).scalar_subquery()))
+    db.session.execute(update(Posts).values(
+        comment_count=db.select(func.count(Comments.id))
+        .where(Comments.post_id == Posts.id).scalar_subquery()))
+    db.session.commit()
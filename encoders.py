@@ -0,0 +1,126 @@
+"""
+This module takes care of the response encoding of the api Blueprint. jsonify goes through
+NegotiatingJSONProvider, which answers MessagePack when the Accept header prefers it and JSON otherwise,
+written by orjson when it is installed. compress_response then compresses the bodies above
+RESPONSE_COMPRESSION_MIN_SIZE with brotli or gzip, following Accept-Encoding. msgpack, orjson and brotli
+are optional, without them the provider falls back to the app JSON provider and gzip
+"""
+import gzip
+from flask import current_app, request, has_request_context
+from api.instrumentation import WrappingJSONProvider
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+
+JSON = "application/json"
+MSGPACK = "application/msgpack"
+MSGPACK_TYPES = (MSGPACK, "application/x-msgpack")
+
+
+def negotiate_media_type():
+    # JSON first, so it wins when the client accepts anything or sends no Accept header
+    if msgpack is None or not has_request_context() or request.blueprint != "api":
+        return JSON
+    best = request.accept_mimetypes.best_match((JSON, *MSGPACK_TYPES), default=JSON)
+    return MSGPACK if best in MSGPACK_TYPES else JSON
+
+
+def encode_json(obj, default, sort_keys=True):
+    option = orjson.OPT_PASSTHROUGH_DATETIME | orjson.OPT_NON_STR_KEYS
+    if sort_keys:
+        option |= orjson.OPT_SORT_KEYS
+    return orjson.dumps(obj, default=default, option=option)
+
+
+def encode_msgpack(obj, default):
+    return msgpack.packb(obj, default=default, use_bin_type=True)
+
+
+def compress_gzip(data):
+    return gzip.compress(data, compresslevel=6)
+
+
+def compress_brotli(data):
+    return brotli.compress(data, quality=4)
+
+
+COMPRESSORS = {"br": compress_brotli, "gzip": compress_gzip} if brotli else {"gzip": compress_gzip}
+
+
+class NegotiatingJSONProvider(WrappingJSONProvider):
+    # Objects the encoders cannot encode natively go through the wrapped provider default, so dates and
+    # decimals look the same whatever the encoder
+
+    def default(self, obj):
+        default = getattr(self.provider, "default", None)
+        if default is None:
+            raise TypeError(f"Object of type {type(obj).__name__} is not serializable")
+        return default(obj)
+
+    def dumps(self, obj, **kwargs):
+        return self.provider.dumps(obj, **kwargs)
+
+    def loads(self, s, **kwargs):
+        return self.provider.loads(s, **kwargs)
+
+    def response(self, *args, **kwargs):
+        # Pretty printed responses are left to the wrapped provider
+        compact = getattr(self.provider, "compact", None)
+        if not has_request_context() or request.blueprint != "api" or compact is False or (
+                compact is None and self._app.debug):
+            return self.provider.response(*args, **kwargs)
+        obj = self._prepare_response_obj(args, kwargs)
+        if negotiate_media_type() == MSGPACK:
+            return self._app.response_class(encode_msgpack(obj, self.default), mimetype=MSGPACK)
+        if orjson is None:
+            return self.provider.response(*args, **kwargs)
+        try:
+            body = encode_json(obj, self.default, getattr(self.provider, "sort_keys", True))
+        except (TypeError, orjson.JSONEncodeError):
+            # e.g. integers above 64 bits, the app provider still encodes them
+            return self.provider.response(*args, **kwargs)
+        return self._app.response_class(body, mimetype=getattr(self.provider, "mimetype", JSON))
+
+
+def init_encoders(app):
+    if not app.config.get("RESPONSE_ENCODERS", True) or "response_encoders" in app.extensions:
+        return
+    app.extensions["response_encoders"] = True
+    app.json = NegotiatingJSONProvider(app, app.json)
+
+
+def compress_response(response):
+    # after_request of the api Blueprint, streamed responses like the exports are left untouched
+    if msgpack is not None:
+        response.vary.add("Accept")
+    if not current_app.config.get("RESPONSE_COMPRESSION", True) or response.is_streamed:
+        return response
+    response.vary.add("Accept-Encoding")
+    if (response.status_code < 200 or response.status_code in (204, 206, 304)
+            or response.direct_passthrough or "Content-Encoding" in response.headers):
+        return response
+    data = response.get_data()
+    if len(data) < current_app.config.get("RESPONSE_COMPRESSION_MIN_SIZE", 1024):
+        return response
+    encoding = request.accept_encodings.best_match(tuple(COMPRESSORS))
+    if not encoding:
+        return response
+    response.set_data(COMPRESSORS[encoding](data))
+    response.headers["Content-Encoding"] = encoding
+    etag, weak = response.get_etag()
+    if etag:
+        # The compressed body is another representation, so it gets its own ETag and its own 304
+        response.set_etag(f"{etag}-{encoding}", weak)
+        response = response.make_conditional(request)
+    return response
@@ -0,0 +1,85 @@
+"""
+This module takes care of the entity cache used by the existence and ownership checks of the routes.
+Lightweight user ({"id", "is_active"}) and post ({"id", "user_id"}) records are kept per worker in a TTL+LRU
+cache, or shared with ENTITY_CACHE_BACKEND set to "redis", so the guards of hot routes skip the database.
+Only existing rows are cached, a missing id is always looked up again so a new row is never hidden
+"""
+import threading
+from flask import current_app
+from api.models import db, Users, Posts
+from api.cache import LRUBackend, RedisBackend
+
+
+class EntityCache:
+
+    def __init__(self, backend):
+        self.backend = backend
+        self.hits = {"user": 0, "post": 0}
+        self.misses = {"user": 0, "post": 0}
+        self.lock = threading.Lock()
+
+    def get_users(self, user_ids, session=None):
+        return self.get_many("user", user_ids, self.load_users, session)
+
+    def get_posts(self, post_ids, session=None):
+        return self.get_many("post", post_ids, self.load_posts, session)
+
+    def get_user(self, user_id, session=None):
+        return self.get_users([user_id], session).get(user_id, None)
+
+    def get_post(self, post_id, session=None):
+        return self.get_posts([post_id], session).get(post_id, None)
+
+    def get_many(self, kind, entity_ids, load, session=None):
+        # Returns {id: record} for the ids that exist, the misses are loaded with a single IN query
+        records = {}
+        missing = []
+        for entity_id in set(entity_ids):
+            record = self.backend.get(f"{kind}:{entity_id}")
+            if record is None:
+                missing.append(entity_id)
+            else:
+                records[entity_id] = record
+        with self.lock:
+            self.hits[kind] += len(records)
+            self.misses[kind] += len(missing)
+        if missing:
+            for record in load(missing, session):
+                self.backend.set(f"{kind}:{record['id']}", record, f"entity:{kind}:{record['id']}")
+                records[record["id"]] = record
+        return records
+
+    def load_users(self, user_ids, session=None):
+        session = session if session is not None else db.session
+        rows = session.execute(db.select(Users.id, Users.is_active).where(Users.id.in_(user_ids))).all()
+        return [{"id": row.id, "is_active": row.is_active} for row in rows]
+
+    def load_posts(self, post_ids, session=None):
+        session = session if session is not None else db.session
+        rows = session.execute(db.select(Posts.id, Posts.user_id).where(Posts.id.in_(post_ids))).all()
+        return [{"id": row.id, "user_id": row.user_id} for row in rows]
+
+    def invalidate(self, kind, *entity_ids):
+        # Call it after the commit, like api.cache.invalidate
+        for entity_id in set(entity_ids):
+            self.backend.invalidate(f"entity:{kind}:{entity_id}")
+
+    def metrics(self):
+        with self.lock:
+            return {kind: {"hits": self.hits[kind],
+                           "misses": self.misses[kind],
+                           "hit_ratio": self.hits[kind] / (self.hits[kind] + self.misses[kind])
+                           if self.hits[kind] + self.misses[kind] else None}
+                    for kind in self.hits}
+
+
+def get_entity_cache():
+    if "entity_cache" not in current_app.extensions:
+        backend = current_app.config.get("ENTITY_CACHE_BACKEND", "lru")
+        ttl = current_app.config.get("ENTITY_CACHE_TTL", 60)
+        if backend == "lru":
+            backend = LRUBackend(current_app.config.get("ENTITY_CACHE_MAX_ENTRIES", 100000), ttl)
+        elif backend == "redis":
+            backend = RedisBackend(current_app.config["ENTITY_CACHE_REDIS_URL"], ttl, "api-entities:")
+        current_app.extensions["entity_cache"] = EntityCache(backend)
+    return current_app.extensions["entity_cache"]
@@ -0,0 +1,59 @@
+"""
+This module takes care of exporting all the data of an account as NDJSON. Rows are read with server side
+cursors (yield_per) and written through generators, so memory stays flat whatever the account size
+"""
+import json
+import zlib
+from api.models import db, Users, Followers, Posts, Media, Comments
+
+
+def iter_account_records(user_id, yield_per=1000, session=None):
+    session = session if session is not None else db.session
+    user = session.execute(db.select(Users.id, Users.email, Users.is_active, Users.is_admin,
+                                     Users.first_name, Users.last_name)
+                           .where(Users.id == user_id)).first()
+    if not user:
+        return
+    yield {"type": "user", "data": dict(user._mapping)}
+    exports = [("post", db.select(Posts.id, Posts.title, Posts.description, Posts.body, Posts.date, Posts.user_id)
+                .where(Posts.user_id == user_id).order_by(Posts.id)),
+               ("medium", db.select(Media.id, Media.medium_type, Media.url, Media.post_id)
+                .join(Posts, Posts.id == Media.post_id)
+                .where(Posts.user_id == user_id).order_by(Media.id)),
+               ("comment", db.select(Comments.id, Comments.body, Comments.user_id, Comments.post_id)
+                .where(Comments.user_id == user_id).order_by(Comments.id)),
+               ("follower", db.select(Followers.id, Followers.following_id, Followers.follower_id)
+                .where(Followers.following_id == user_id).order_by(Followers.id)),
+               ("following", db.select(Followers.id, Followers.following_id, Followers.follower_id)
+                .where(Followers.follower_id == user_id).order_by(Followers.id))]
+    for record_type, query in exports:
+        for row in session.execute(query.execution_options(yield_per=yield_per)):
+            data = dict(row._mapping)
+            if "date" in data:
+                data["date"] = data["date"].strftime("%d-%m-%Y")
+            yield {"type": record_type, "data": data}
+
+
+def iter_ndjson(records, buffer_size=65536):
+    # One JSON document per line, lines are grouped in chunks of about buffer_size bytes
+    buffer = []
+    size = 0
+    for record in records:
+        line = json.dumps(record, separators=(",", ":")) + "\n"
+        buffer.append(line)
+        size += len(line)
+        if size >= buffer_size:
+            yield "".join(buffer).encode()
+            buffer = []
+            size = 0
+    if buffer:
+        yield "".join(buffer).encode()
+
+
+def iter_gzip(chunks):
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 31)
+    for chunk in chunks:
+        compressed = compressor.compress(chunk)
+        if compressed:
+            yield compressed
+    yield compressor.flush()
@@ -0,0 +1,89 @@
+"""
+This module takes care of the home feed: posts are fanned out to the followers timelines on write,
+while posts from celebrity accounts (above FEED_CELEBRITY_THRESHOLD followers) are merged at read time
+"""
+from flask import current_app
+from sqlalchemy import func, insert, delete, literal, and_, or_
+from api.models import db, Users, Followers, Posts, Timelines
+from api.pagination import split_page
+
+
+def get_celebrity_threshold():
+    return current_app.config.get("FEED_CELEBRITY_THRESHOLD", 10000)
+
+
+def select_celebrities(user_ids):
+    # Users from user_ids whose followers exceed the threshold, they are not fanned out on write
+    return db.select(Users.id).where(Users.id.in_(user_ids),
+                                     Users.follower_count > get_celebrity_threshold())
+
+
+def fan_out_posts(post_ids, session=None):
+    # One INSERT ... SELECT copies the new posts into the timeline of every follower of their authors
+    session = session if session is not None else db.session
+    if not post_ids:
+        return
+    authors = db.select(Posts.user_id).where(Posts.id.in_(post_ids))
+    rows = (db.select(Followers.follower_id, Posts.id, Posts.user_id, Posts.date)
+            .join(Followers, Followers.following_id == Posts.user_id)
+            .where(Posts.id.in_(post_ids),
+                   Posts.user_id.not_in(select_celebrities(authors))))
+    session.execute(insert(Timelines).from_select(
+        ["user_id", "post_id", "author_id", "date"], rows))
+
+
+def backfill_timeline(user_id, following_ids, session=None):
+    # New follows copy the latest posts of each followed user in one INSERT ... SELECT, celebrities excepted
+    session = session if session is not None else db.session
+    limit = current_app.config.get("FEED_BACKFILL_LIMIT", 50)
+    recent_posts = (db.select(Posts.id, Posts.user_id, Posts.date,
+                              func.row_number().over(partition_by=Posts.user_id,
+                                                     order_by=(Posts.date.desc(), Posts.id.desc())).label("position"))
+                    .where(Posts.user_id.in_(following_ids),
+                           Posts.user_id.not_in(select_celebrities(following_ids)))
+                    .subquery())
+    rows = (db.select(literal(user_id), recent_posts.c.id, recent_posts.c.user_id, recent_posts.c.date)
+            .where(recent_posts.c.position <= limit))
+    session.execute(insert(Timelines).from_select(
+        ["user_id", "post_id", "author_id", "date"], rows))
+
+
+def remove_from_timeline(user_id, following_id, session=None):
+    session = session if session is not None else db.session
+    session.execute(delete(Timelines).where(Timelines.user_id == user_id,
+                                               Timelines.author_id == following_id))
+
+
+def get_feed(user_id, limit, cursor, posts_query=None, session=None):
+    # Both sources are read newest first from their (date, id) indexes, limit + 1 rows tell if there is a next page
+    session = session if session is not None else db.session
+    timeline_query = (db.select(Timelines.post_id, Timelines.date)
+                      .where(Timelines.user_id == user_id)
+                      .order_by(Timelines.date.desc(), Timelines.post_id.desc())
+                      .limit(limit + 1))
+    following = db.select(Followers.following_id).where(Followers.follower_id == user_id)
+    celebrity_query = (db.select(Posts.id, Posts.date)
+                       .where(Posts.user_id.in_(select_celebrities(following)))
+                       .order_by(Posts.date.desc(), Posts.id.desc())
+                       .limit(limit + 1))
+    if cursor:
+        timeline_query = timeline_query.where(or_(
+            Timelines.date < cursor["date"],
+            and_(Timelines.date == cursor["date"], Timelines.post_id < cursor["id"])))
+        celebrity_query = celebrity_query.where(or_(
+            Posts.date < cursor["date"],
+            and_(Posts.date == cursor["date"], Posts.id < cursor["id"])))
+    timeline = session.execute(timeline_query).all()
+    celebrity_posts = session.execute(celebrity_query).all()
+    # Merge both sources newest first, a post may be in both if its author became a celebrity later
+    merged = sorted({tuple(row) for row in timeline} | {tuple(row) for row in celebrity_posts},
+                    key=lambda row: (row[1], row[0]), reverse=True)
+    page, last = split_page(merged, limit)
+    next_cursor = {"date": last[1], "id": last[0]} if last else None
+    post_ids = [row[0] for row in page]
+    if not post_ids:
+        return [], next_cursor
+    posts_query = posts_query if posts_query is not None else db.select(Posts)
+    posts = session.execute(posts_query.where(Posts.id.in_(post_ids))).scalars().all()
+    positions = {post_id: position for position, post_id in enumerate(post_ids)}
+    return sorted(posts, key=lambda post: positions[post.id]), next_cursor
@@ -0,0 +1,165 @@
+"""
+This module takes care of the in-process follow graph. Followers and following of each user are kept as
+sorted integer arrays, loaded lazily from the Followers table, kept current by the follow routes and
+evicted least recently used first, so graph questions are answered on compact arrays instead of ORM rows
+"""
+import threading
+import time
+from array import array
+from bisect import bisect_left
+from collections import Counter, OrderedDict
+from flask import current_app
+from api.models import db, Followers
+
+
+FOLLOWING = "following"
+FOLLOWERS = "followers"
+
+
+def contains(ids, user_id):
+    position = bisect_left(ids, user_id)
+    return position < len(ids) and ids[position] == user_id
+
+
+def intersect(first, second):
+    # Merge both sorted arrays, or binary search the small one in the big one when sizes are far apart
+    if len(first) > len(second):
+        first, second = second, first
+    if len(first) * 8 < len(second):
+        return [user_id for user_id in first if contains(second, user_id)]
+    result = []
+    i = j = 0
+    while i < len(first) and j < len(second):
+        if first[i] == second[j]:
+            result.append(first[i])
+            i += 1
+            j += 1
+        elif first[i] < second[j]:
+            i += 1
+        else:
+            j += 1
+    return result
+
+
+class FollowGraph:
+
+    def __init__(self, max_ids=5000000, ttl=60):
+        self.max_ids = max_ids
+        self.ttl = ttl
+        self.total_ids = 0
+        self.entries = OrderedDict()
+        # Lists being loaded and how many edges changed them meanwhile, a changed list is not stored because
+        # its rows may have been read before the edge was committed
+        self.loading = Counter()
+        self.versions = Counter()
+        self.lock = threading.Lock()
+
+    def following(self, user_id):
+        return self.load(FOLLOWING, [user_id])[user_id]
+
+    def followers(self, user_id):
+        return self.load(FOLLOWERS, [user_id])[user_id]
+
+    def load(self, direction, user_ids):
+        # Cached lists are returned as they are, the missing ones are loaded together with one query
+        results = {}
+        missing = []
+        now = time.monotonic()
+        with self.lock:
+            for user_id in user_ids:
+                entry = self.entries.get((direction, user_id), None)
+                if entry and entry[0] + self.ttl > now:
+                    self.entries.move_to_end((direction, user_id))
+                    results[user_id] = entry[1]
+                else:
+                    missing.append(user_id)
+            versions = {user_id: self.versions[(direction, user_id)] for user_id in missing}
+            self.loading.update((direction, user_id) for user_id in missing)
+        if not missing:
+            return results
+        if direction == FOLLOWING:
+            key_column, value_column = Followers.follower_id, Followers.following_id
+        else:
+            key_column, value_column = Followers.following_id, Followers.follower_id
+        loaded = {user_id: array("q") for user_id in missing}
+        complete = False
+        try:
+            rows = db.session.execute(db.select(key_column, value_column)
+                                      .where(key_column.in_(missing))
+                                      .order_by(key_column, value_column))
+            for key, value in rows:
+                loaded[key].append(value)
+            complete = True
+        finally:
+            with self.lock:
+                for user_id in missing:
+                    key = (direction, user_id)
+                    if complete and self.versions[key] == versions[user_id]:
+                        self._store(key, loaded[user_id], now)
+                    self.loading[key] -= 1
+                    if self.loading[key] <= 0:
+                        del self.loading[key]
+                        self.versions.pop(key, None)
+        results.update(loaded)
+        return results
+
+    def add_edge(self, follower_id, following_id):
+        with self.lock:
+            self._update((FOLLOWING, follower_id), following_id, True)
+            self._update((FOLLOWERS, following_id), follower_id, True)
+
+    def remove_edge(self, follower_id, following_id):
+        with self.lock:
+            self._update((FOLLOWING, follower_id), following_id, False)
+            self._update((FOLLOWERS, following_id), follower_id, False)
+
+    def follows(self, follower_id, following_id):
+        return contains(self.following(follower_id), following_id)
+
+    def mutual(self, user_id):
+        return intersect(self.following(user_id), self.followers(user_id))
+
+    def suggestions(self, user_id, limit, max_friends=200):
+        # Friends of friends ranked by how many of the users followed by user_id also follow them
+        following = self.following(user_id)
+        friends = list(following[:max_friends])
+        candidates = Counter()
+        for ids in self.load(FOLLOWING, friends).values():
+            candidates.update(ids)
+        return [(candidate, overlap) for candidate, overlap in candidates.most_common()
+                if candidate != user_id and not contains(following, candidate)][:limit]
+
+    def _update(self, key, user_id, add):
+        # Only lists already in memory are updated, the others will be loaded with the new edge
+        if key in self.loading:
+            self.versions[key] += 1
+        entry = self.entries.get(key, None)
+        if not entry:
+            return
+        # Copy on write, readers iterate the arrays they got outside the lock, so a stored array never changes
+        loaded_at, ids = entry
+        position = bisect_left(ids, user_id)
+        present = position < len(ids) and ids[position] == user_id
+        if add and not present:
+            self.entries[key] = (loaded_at, ids[:position] + array("q", [user_id]) + ids[position:])
+            self.total_ids += 1
+        elif not add and present:
+            self.entries[key] = (loaded_at, ids[:position] + ids[position + 1:])
+            self.total_ids -= 1
+
+    def _store(self, key, ids, loaded_at):
+        previous = self.entries.pop(key, None)
+        if previous:
+            self.total_ids -= len(previous[1])
+        self.entries[key] = (loaded_at, ids)
+        self.total_ids += len(ids)
+        while self.total_ids > self.max_ids and len(self.entries) > 1:
+            _, (_, evicted) = self.entries.popitem(last=False)
+            self.total_ids -= len(evicted)
+
+
+def get_follow_graph():
+    if "follow_graph" not in current_app.extensions:
+        current_app.extensions["follow_graph"] = FollowGraph(current_app.config.get("FOLLOW_GRAPH_MAX_IDS", 5000000),
+                                                             current_app.config.get("FOLLOW_GRAPH_TTL", 60))
+    return current_app.extensions["follow_graph"]
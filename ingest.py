@@ -0,0 +1,277 @@
+"""
+This module takes care of the optional write-behind ingestion of comments. With COMMENT_INGEST_MODE set to
+"queue", POST /posts/<id>/comments validates the comment, puts it in a bounded in-process queue and answers
+202 with a provisional id, and a background flusher writes the queue in group commits by size or time.
+With COMMENT_INGEST_JOURNAL set, every process appends the comments it accepts to its own journal
+(COMMENT_INGEST_JOURNAL.<pid>) before answering, and journals left by dead processes are replayed on the
+next start, the provisional id keeps the replay from duplicating them. Submitters arriving together share
+one fsync, and the journal is truncated whenever everything in it is committed
+"""
+import atexit
+import fcntl
+import glob
+import json
+import logging
+import os
+import queue
+import threading
+import time
+import uuid
+from collections import deque
+from flask import current_app
+from sqlalchemy.exc import OperationalError
+from api.models import db, Comments, dialect_insert
+from api.counters import count_comments
+from api.trending import record_engagement
+from api.search import index_documents, comment_document
+from api.cache import invalidate
+
+
+logger = logging.getLogger(__name__)
+MAX_BODY_LENGTH = 2200
+
+
+def is_transient(error):
+    # Lost connections and locked databases go away by themselves, anything else is a bad comment
+    return isinstance(error, OperationalError) or getattr(error, "connection_invalidated", False)
+
+
+class CommentIngestQueue:
+
+    def __init__(self, app, max_size=10000, batch_size=500, flush_interval=0.05, journal_path=None):
+        self.app = app
+        self.queue = queue.Queue(max_size)
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.journal_path = journal_path
+        self.journal = None
+        # Replayed comments wait here instead of the bounded queue, so replaying never blocks
+        self.backlog = deque()
+        # Reentrant so submit can journal while holding it, queueing and journaling are atomic together
+        self.journal_lock = threading.RLock()
+        # ingest ids journaled but not committed or rejected yet, the journal is truncated when it is empty
+        self.pending = set()
+        # Records appended and records known to be on disk, one fsync covers every record appended before it
+        self.appended = 0
+        self.synced = 0
+        self.syncing = False
+        self.sync_condition = threading.Condition()
+        self.stopping = threading.Event()
+        self.thread = threading.Thread(target=self.run, name="comment-ingest", daemon=True)
+
+    def start(self):
+        if self.journal_path:
+            # The lock tells the other processes this journal is alive, it is released when the process dies
+            self.journal = open(f"{self.journal_path}.{os.getpid()}", "a")
+            fcntl.flock(self.journal.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+            comments, paths = self.replay_journals()
+            for comment in comments:
+                self.write_journal(comment)
+                self.backlog.append(comment)
+            # The old journals are only deleted once their comments are safe in this one
+            self.sync_journal(self.appended)
+            for path in paths:
+                os.remove(path)
+        self.thread.start()
+        atexit.register(self.stop)
+
+    def submit(self, body, user_id, post_id):
+        # Raises ValueError for an invalid comment, and queue.Full when the flusher is behind so callers
+        # answer 503 and clients back off
+        if not isinstance(body, str) or len(body) > MAX_BODY_LENGTH:
+            raise ValueError(f"Comment body must be a string of at most {MAX_BODY_LENGTH} characters")
+        if self.stopping.is_set():
+            raise queue.Full
+        comment = {"ingest_id": str(uuid.uuid4()), "body": body, "user_id": user_id, "post_id": post_id}
+        with self.journal_lock:
+            self.queue.put_nowait(comment)
+            position = self.write_journal(comment)
+        # Outside the lock, so the other submitters keep appending and share the next fsync
+        self.sync_journal(position)
+        return comment
+
+    def stop(self, timeout=30):
+        # Stops accepting comments and drains the queue before the process exits
+        if self.stopping.is_set():
+            return
+        self.stopping.set()
+        if self.thread.is_alive():
+            self.thread.join(timeout)
+        if self.journal:
+            self.journal.close()
+
+    def run(self):
+        while not (self.stopping.is_set() and self.queue.empty() and not self.backlog):
+            batch = self.collect()
+            if batch:
+                self.flush(batch)
+
+    def collect(self):
+        batch = []
+        while self.backlog and len(batch) < self.batch_size:
+            batch.append(self.backlog.popleft())
+        deadline = time.monotonic() + self.flush_interval
+        while len(batch) < self.batch_size:
+            try:
+                batch.append(self.queue.get(timeout=max(deadline - time.monotonic(), 0.001)))
+            except queue.Empty:
+                break
+        return batch
+
+    def flush(self, batch):
+        attempts = 0
+        while batch:
+            try:
+                with self.app.app_context():
+                    self.write(batch)
+                self.settle_journal([comment["ingest_id"] for comment in batch], {
+                    "committed": [comment["ingest_id"] for comment in batch]})
+                return
+            except Exception as error:
+                if not is_transient(error):
+                    # A bad comment must not hold back the others, they are written one by one
+                    logger.exception("Group commit of %s comments failed, writing them one by one", len(batch))
+                    batch = self.flush_each(batch)
+                    if not batch:
+                        return
+                else:
+                    logger.exception("Group commit of %s comments failed", len(batch))
+            attempts += 1
+            if self.stopping.is_set() and attempts >= 3:
+                # They stay in the journal and are replayed on the next start
+                return
+            time.sleep(min(self.flush_interval * 2 ** attempts, 5))
+
+    def flush_each(self, batch):
+        # Returns the comments that failed for a transient reason, the rejected ones are set aside in the journal
+        remaining = []
+        for comment in batch:
+            try:
+                with self.app.app_context():
+                    self.write([comment])
+                self.settle_journal([comment["ingest_id"]], {"committed": [comment["ingest_id"]]})
+            except Exception as error:
+                if is_transient(error):
+                    remaining.append(comment)
+                    continue
+                logger.exception("Comment %s rejected by the database, it is dropped", comment["ingest_id"])
+                self.settle_journal([comment["ingest_id"]], {"rejected": comment})
+        return remaining
+
+    def write(self, batch):
+        # One executemany insert and one commit for the whole batch, replayed comments are skipped
+        try:
+            inserted = db.session.execute(
+                dialect_insert(Comments)
+                .on_conflict_do_nothing(index_elements=["ingest_id"])
+                .returning(Comments.id, Comments.ingest_id), batch).all()
+            comment_ids = {row.ingest_id: row.id for row in inserted}
+            created = [comment for comment in batch if comment["ingest_id"] in comment_ids]
+            count_comments([comment["post_id"] for comment in created])
+            record_engagement([comment["post_id"] for comment in created], "comments")
+            index_documents([comment_document(comment_ids[comment["ingest_id"]], comment["post_id"], comment["body"])
+                             for comment in created])
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+            raise
+        finally:
+            db.session.remove()
+        invalidate("comments", *[comment["post_id"] for comment in created])
+        invalidate("user", *[comment["user_id"] for comment in created])
+
+    def write_journal(self, record):
+        # Appends a comment, it is durable once sync_journal reached the returned position
+        if not self.journal:
+            return 0
+        with self.journal_lock:
+            self.journal.write(json.dumps(record) + "\n")
+            self.journal.flush()
+            self.pending.add(record["ingest_id"])
+            self.appended += 1
+            return self.appended
+
+    def sync_journal(self, position):
+        # Group fsync: the first waiting submitter syncs every record appended so far, the others wait for it
+        if not self.journal:
+            return
+        with self.sync_condition:
+            while self.synced < position:
+                if not self.syncing:
+                    break
+                self.sync_condition.wait()
+            else:
+                return
+            self.syncing = True
+        target = self.appended
+        try:
+            os.fsync(self.journal.fileno())
+        finally:
+            with self.sync_condition:
+                self.syncing = False
+                self.synced = max(self.synced, target)
+                self.sync_condition.notify_all()
+
+    def settle_journal(self, ingest_ids, record):
+        # Committed and rejected records are not synced, losing one only replays comments the ingest id skips
+        if not self.journal:
+            return
+        with self.journal_lock:
+            self.pending.difference_update(ingest_ids)
+            if self.pending:
+                self.journal.write(json.dumps(record) + "\n")
+                self.journal.flush()
+                return
+            # Nothing left to replay, the journal starts over. Appends go to its end, so they follow
+            self.journal.truncate(0)
+
+    def replay_journals(self):
+        # Takes over the journals of dead processes, their comments accepted but never committed are
+        # copied to this process journal by the caller before it deletes the returned paths
+        pending = {}
+        paths = []
+        for path in glob.glob(f"{glob.escape(self.journal_path)}.*"):
+            if path == self.journal.name or not path.rsplit(".", 1)[-1].isdigit():
+                continue
+            with open(path) as journal:
+                try:
+                    fcntl.flock(journal.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except OSError:
+                    # Its process is still running
+                    continue
+                comments = self.read_journal(journal)
+            if comments:
+                logger.warning("Replaying %s comments from %s", len(comments), path)
+            for comment in comments:
+                pending[comment["ingest_id"]] = comment
+            paths.append(path)
+        return list(pending.values()), paths
+
+    def read_journal(self, journal):
+        pending = {}
+        for line in journal:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                # A torn last line from a crash, the comment was never acknowledged
+                continue
+            if "committed" in record:
+                for ingest_id in record["committed"]:
+                    pending.pop(ingest_id, None)
+            elif "rejected" in record:
+                pending.pop(record["rejected"]["ingest_id"], None)
+            else:
+                pending[record["ingest_id"]] = record
+        return list(pending.values())
+
+
+def get_comment_queue():
+    if "comment_ingest_queue" not in current_app.extensions:
+        ingest_queue = CommentIngestQueue(current_app._get_current_object(),
+                                          current_app.config.get("COMMENT_INGEST_MAX_SIZE", 10000),
+                                          current_app.config.get("COMMENT_INGEST_BATCH_SIZE", 500),
+                                          current_app.config.get("COMMENT_INGEST_FLUSH_INTERVAL", 0.05),
+                                          current_app.config.get("COMMENT_INGEST_JOURNAL", None))
+        current_app.extensions["comment_ingest_queue"] = ingest_queue
+        ingest_queue.start()
+    return current_app.extensions["comment_ingest_queue"]
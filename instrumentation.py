@@ -0,0 +1,172 @@
+"""
+This module takes care of the opt-in per request instrumentation. With SQL_INSTRUMENTATION enabled every
+request counts its SQL statements and database time, times the JSON serialization, answers with a
+Server-Timing header, logs slow statements and N+1 patterns and aggregates the stats per endpoint
+"""
+import logging
+import re
+import threading
+import time
+from collections import Counter
+from flask import g, request, has_request_context
+from flask.json.provider import JSONProvider
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+
+logger = logging.getLogger(__name__)
+PLACEHOLDERS = re.compile(r"\((?:\s*(?:\?|%\(\w+\)s|%s|:\w+|\$\d+)\s*,?)+\)")
+
+
+class RequestStats:
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.statements = 0
+        self.db_time = 0.0
+        self.serialize_time = 0.0
+        self.shapes = Counter()
+        self.slow_statements = 0
+
+
+class EndpointStats:
+    # Aggregated stats per endpoint for the admin endpoint, shared by all the threads of the worker
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.endpoints = {}
+
+    def add(self, endpoint, stats, total_time, n_plus_one):
+        with self.lock:
+            endpoint_stats = self.endpoints.setdefault(endpoint, {"requests": 0,
+                                                                  "total_time": 0.0,
+                                                                  "max_time": 0.0,
+                                                                  "db_time": 0.0,
+                                                                  "serialize_time": 0.0,
+                                                                  "statements": 0,
+                                                                  "slow_statements": 0,
+                                                                  "n_plus_one_requests": 0})
+            endpoint_stats["requests"] += 1
+            endpoint_stats["total_time"] += total_time
+            endpoint_stats["max_time"] = max(endpoint_stats["max_time"], total_time)
+            endpoint_stats["db_time"] += stats.db_time
+            endpoint_stats["serialize_time"] += stats.serialize_time
+            endpoint_stats["statements"] += stats.statements
+            endpoint_stats["slow_statements"] += stats.slow_statements
+            endpoint_stats["n_plus_one_requests"] += 1 if n_plus_one else 0
+
+    def snapshot(self):
+        with self.lock:
+            return {endpoint: {"requests": stats["requests"],
+                               "avg_ms": round(stats["total_time"] / stats["requests"] * 1000, 3),
+                               "max_ms": round(stats["max_time"] * 1000, 3),
+                               "avg_db_ms": round(stats["db_time"] / stats["requests"] * 1000, 3),
+                               "avg_serialize_ms": round(stats["serialize_time"] / stats["requests"] * 1000, 3),
+                               "avg_statements": round(stats["statements"] / stats["requests"], 2),
+                               "slow_statements": stats["slow_statements"],
+                               "n_plus_one_requests": stats["n_plus_one_requests"]}
+                    for endpoint, stats in self.endpoints.items()}
+
+
+class WrappingJSONProvider(JSONProvider):
+    # Base of the providers wrapping app.json, settings like sort_keys, compact, mimetype or default are
+    # read from and written to the wrapped provider, so app.json.compact = False still works
+
+    def __init__(self, app, provider):
+        super().__init__(app)
+        self.provider = provider
+
+    def __getattr__(self, name):
+        if name == "provider":
+            raise AttributeError(name)
+        return getattr(self.provider, name)
+
+    def __setattr__(self, name, value):
+        if name in ("_app", "provider"):
+            super().__setattr__(name, value)
+        else:
+            setattr(self.provider, name, value)
+
+
+class TimingJSONProvider(WrappingJSONProvider):
+    # Wraps the app JSON provider so the time spent in jsonify is reported apart from the database time
+
+    def dumps(self, obj, **kwargs):
+        started = time.perf_counter()
+        try:
+            return self.provider.dumps(obj, **kwargs)
+        finally:
+            add_serialize_time(time.perf_counter() - started)
+
+    def loads(self, s, **kwargs):
+        return self.provider.loads(s, **kwargs)
+
+    def response(self, *args, **kwargs):
+        started = time.perf_counter()
+        try:
+            return self.provider.response(*args, **kwargs)
+        finally:
+            add_serialize_time(time.perf_counter() - started)
+
+
+def get_request_stats():
+    if not has_request_context():
+        return None
+    return g.get("request_stats", None)
+
+
+def add_serialize_time(elapsed):
+    stats = get_request_stats()
+    if stats:
+        stats.serialize_time += elapsed
+
+
+def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    if get_request_stats():
+        conn.info.setdefault("statement_started", []).append(time.perf_counter())
+
+
+def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    stats = get_request_stats()
+    if not stats or not conn.info.get("statement_started"):
+        return
+    elapsed = time.perf_counter() - conn.info["statement_started"].pop()
+    stats.statements += 1
+    stats.db_time += elapsed
+    stats.shapes[PLACEHOLDERS.sub("(?)", statement)] += 1
+    if elapsed > g.sql_slow_query_threshold:
+        stats.slow_statements += 1
+        logger.warning("Slow statement in %s (%.1f ms): %s", request.endpoint, elapsed * 1000, statement)
+
+
+def init_instrumentation(app):
+    if not app.config.get("SQL_INSTRUMENTATION", False) or "sql_instrumentation" in app.extensions:
+        return
+    endpoint_stats = EndpointStats()
+    app.extensions["sql_instrumentation"] = endpoint_stats
+    app.json = TimingJSONProvider(app, app.json)
+    slow_query_threshold = app.config.get("SQL_SLOW_QUERY_THRESHOLD", 0.1)
+    n_plus_one_threshold = app.config.get("SQL_N_PLUS_ONE_THRESHOLD", 10)
+    if not event.contains(Engine, "before_cursor_execute", before_cursor_execute):
+        event.listen(Engine, "before_cursor_execute", before_cursor_execute)
+        event.listen(Engine, "after_cursor_execute", after_cursor_execute)
+
+    @app.before_request
+    def start_request_stats():
+        g.request_stats = RequestStats()
+        g.sql_slow_query_threshold = slow_query_threshold
+
+    @app.after_request
+    def finish_request_stats(response):
+        stats = g.pop("request_stats", None)
+        if not stats:
+            return response
+        total_time = time.perf_counter() - stats.started
+        repeated = {shape: count for shape, count in stats.shapes.items() if count > n_plus_one_threshold}
+        for shape, count in repeated.items():
+            logger.warning("Possible N+1 in %s, statement repeated %s times: %s", request.endpoint, count, shape)
+        endpoint_stats.add(request.endpoint or "unmatched", stats, total_time, bool(repeated))
+        response.headers.add("Server-Timing", f'db;dur={stats.db_time * 1000:.3f};desc="{stats.statements} statements"')
+        response.headers.add("Server-Timing", f"serialize;dur={stats.serialize_time * 1000:.3f}")
+        response.headers.add("Server-Timing", f"total;dur={total_time * 1000:.3f}")
+        return response
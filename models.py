@@ -1,7 +1,12 @@
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.ext.compiler import compiles
+from sqlalchemy.schema import CreateTable
+from sqlalchemy.orm import Mapped, orm_insert_sentinel
+from api.replicas import RoutingSession
 
 
-db = SQLAlchemy()
+db = SQLAlchemy(session_options={"class_": RoutingSession})
 
 
 class Users(db.Model):
@@ -12,21 +17,15 @@ class Users(db.Model):
     is_admin = db.Column(db.Boolean(), default=False, nullable=False)
     first_name = db.Column(db.String())
     last_name = db.Column(db.String())
+    follower_count = db.Column(db.Integer, default=0, server_default="0", nullable=False)
+    following_count = db.Column(db.Integer, default=0, server_default="0", nullable=False)
+    post_count = db.Column(db.Integer, default=0, server_default="0", nullable=False)
 
     def __repr__(self):
         return f"<User {self.id} - {self.email}>"
 
     def serialize(self):
-        return {"id": self.id,
-                "email": self.email,
-                "is_active": self.is_active,
-                "is_admin": self.is_admin,
-                "first_name": self.first_name,
-                "last_name": self.last_name,
-                "followers": [row.serialize()["follower_id"] for row in self.following_to],
-                "following": [row.serialize()["following_id"] for row in self.follower_to],
-                "posts": [row.serialize()["id"] for row in self.user_posts],
-                "comments": [row.serialize() for row in self.user_comments]}
+        return serialize_users([self])[0]
 
 
 class Followers(db.Model):
@@ -37,6 +36,8 @@ class Followers(db.Model):
     follower_id = db.Column(db.Integer, db.ForeignKey("users.id"))
     follower_to = db.relationship("Users", foreign_keys=[follower_id],
                                   backref=db.backref("follower_to", lazy="select"))
+    __table_args__ = (db.Index("ix_followers_following_follower", "following_id", "follower_id"),
+                      db.Index("ix_followers_follower_following", "follower_id", "following_id", unique=True))
 
     def __repr__(self):
         return f"<Following: {self.following_id} - Followers: {self.follower_id}>"
@@ -53,20 +54,16 @@ class Posts(db.Model):
     description = db.Column(db.String(150))
     body = db.Column(db.String(2200))
     date = db.Column(db.Date(), nullable=False)
+    comment_count = db.Column(db.Integer, default=0, server_default="0", nullable=False)
     user_id = db.Column(db.Integer, db.ForeignKey("users.id"))
     user_to = db.relationship("Users", foreign_keys=[user_id],
                               backref=db.backref("user_posts", lazy="select"))
+    # Lets INSERT ... RETURNING with sort_by_parameter_order send one executemany on every database
+    _sentinel: Mapped[int] = orm_insert_sentinel()
+    __table_args__ = (db.Index("ix_posts_user_date_id", "user_id", "date", "id"),)
 
     def serialize(self):
-        return {
-            "id": self.id,
-            "title": self.title,
-            "description": self.description,
-            "body": self.body,
-            "date": self.date.strftime("%d-%m-%Y"),
-            "medium_to_post": self.medium_to_post.url if self.medium_to_post else None,
-            "comments": [row.serialize() for row in self.comments_to_post] if self.comments_to_post else None,
-            "user_id": self.user_id}
+        return serialize_posts([self])[0]
 
 
 class Media(db.Model):
@@ -95,6 +92,10 @@ class Comments(db.Model):
     post_id = db.Column(db.Integer, db.ForeignKey("posts.id"))
     post_to = db.relationship("Posts", foreign_keys=[post_id],
                               backref=db.backref("comments_to_post", lazy="select"))
+    # Provisional id of the comments written behind by api.ingest, it makes replaying the journal idempotent
+    ingest_id = db.Column(db.String(36), unique=True)
+    _sentinel: Mapped[int] = orm_insert_sentinel()
+    __table_args__ = (db.Index("ix_comments_post_id", "post_id", "id"),)
 
     def serialize(self):
         return {
@@ -102,3 +103,181 @@ class Comments(db.Model):
             "body": self.body,
             "user_id": self.user_id,
             "post_id": self.post_id}
+
+
+class Timelines(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey("users.id"), nullable=False)
+    post_id = db.Column(db.Integer, db.ForeignKey("posts.id"), nullable=False)
+    author_id = db.Column(db.Integer, db.ForeignKey("users.id"), nullable=False)
+    date = db.Column(db.Date(), nullable=False)
+    __table_args__ = (db.UniqueConstraint("user_id", "post_id", name="uq_timelines_user_post"),
+                      db.Index("ix_timelines_user_date_post", "user_id", "date", "post_id"),
+                      db.Index("ix_timelines_user_author", "user_id", "author_id"))
+
+    def __repr__(self):
+        return f"<Timeline {self.user_id} - Post {self.post_id}>"
+
+    def serialize(self):
+        return {
+            "id": self.id,
+            "user_id": self.user_id,
+            "post_id": self.post_id,
+            "author_id": self.author_id,
+            "date": self.date.strftime("%d-%m-%Y")}
+
+
+class PostEngagement(db.Model):
+    # Engagement of a post per time bucket, bucket is the epoch seconds divided by TRENDING_BUCKET_SECONDS
+    id = db.Column(db.Integer, primary_key=True)
+    post_id = db.Column(db.Integer, db.ForeignKey("posts.id"), nullable=False)
+    bucket = db.Column(db.Integer, nullable=False)
+    comments = db.Column(db.Integer, nullable=False, default=0, server_default="0")
+    media = db.Column(db.Integer, nullable=False, default=0, server_default="0")
+    __table_args__ = (db.UniqueConstraint("post_id", "bucket", name="uq_post_engagement_post_bucket"),
+                      db.Index("ix_post_engagement_bucket", "bucket"))
+
+    def __repr__(self):
+        return f"<PostEngagement {self.post_id} - Bucket {self.bucket}>"
+
+
+# Full-text documents of api.search. On PostgreSQL a plain table with a GIN indexed tsvector, on SQLite
+# a FTS5 virtual table with the kind, ref_id, post_id, title and content columns
+search_documents = db.Table(
+    "search_documents",
+    db.Column("id", db.Integer, primary_key=True),
+    db.Column("kind", db.String(10), nullable=False),
+    db.Column("ref_id", db.Integer, nullable=False),
+    db.Column("post_id", db.Integer, nullable=False),
+    db.Column("title", db.Text),
+    db.Column("content", db.Text),
+    db.Column("document", postgresql.TSVECTOR),
+    db.UniqueConstraint("kind", "ref_id", name="uq_search_documents_kind_ref"),
+    db.Index("ix_search_documents_document", "document", postgresql_using="gin").ddl_if(dialect="postgresql"))
+
+
+@compiles(CreateTable, "sqlite")
+def create_sqlite_table(create, compiler, **kwargs):
+    if create.element is not search_documents:
+        return compiler.visit_create_table(create, **kwargs)
+    return ("CREATE VIRTUAL TABLE search_documents USING fts5("
+            "kind UNINDEXED, ref_id UNINDEXED, post_id UNINDEXED, title, content, tokenize = 'porter unicode61')")
+
+
+def include_object(obj, name, type_, reflected, compare_to):
+    # For Alembic's include_object: the FTS5 shadow tables and the columns of the virtual table are not
+    # described by the metadata, autogenerate must leave them alone
+    if type_ == "table" and reflected and compare_to is None and name.startswith("search_documents_"):
+        return False
+    if type_ in ("column", "index", "unique_constraint") and getattr(obj, "table", None) is not None:
+        return obj.table.name != "search_documents"
+    return True
+
+
+def dialect_insert(model, session=None):
+    # INSERT supporting ON CONFLICT for the current database, both SQLite and PostgreSQL implement it
+    session = session if session is not None else db.session
+    if session.get_bind().dialect.name == "postgresql":
+        return postgresql.insert(model)
+    return sqlite.insert(model)
+
+
+USER_RELATIONS = ("followers", "following", "posts", "comments")
+POST_RELATIONS = ("medium_to_post", "comments")
+
+
+def load_user_relations(user_ids, include=USER_RELATIONS, session=None):
+    # Relationships are loaded for all users at once with one query each, never through the lazy backrefs
+    session = session if session is not None else db.session
+    relations = {name: {user_id: [] for user_id in user_ids} for name in include}
+    if not user_ids:
+        return relations
+    if "followers" in include or "following" in include:
+        follows = session.execute(
+            db.select(Followers.following_id, Followers.follower_id)
+            .where(db.or_(Followers.following_id.in_(user_ids), Followers.follower_id.in_(user_ids)))
+            .order_by(Followers.id)).all()
+        followers = relations.get("followers", {})
+        following = relations.get("following", {})
+        for following_id, follower_id in follows:
+            if following_id in followers:
+                followers[following_id].append(follower_id)
+            if follower_id in following:
+                following[follower_id].append(following_id)
+    if "posts" in include:
+        user_posts = session.execute(
+            db.select(Posts.user_id, Posts.id)
+            .where(Posts.user_id.in_(user_ids))
+            .order_by(Posts.id)).all()
+        for user_id, post_id in user_posts:
+            relations["posts"][user_id].append(post_id)
+    if "comments" in include:
+        user_comments = session.execute(
+            db.select(Comments.id, Comments.body, Comments.user_id, Comments.post_id)
+            .where(Comments.user_id.in_(user_ids))
+            .order_by(Comments.id)).all()
+        for row in user_comments:
+            relations["comments"][row.user_id].append({"id": row.id,
+                                                       "body": row.body,
+                                                       "user_id": row.user_id,
+                                                       "post_id": row.post_id})
+    return relations
+
+
+def load_post_relations(post_ids, include=POST_RELATIONS, comments_limit=None, session=None):
+    # Media and comments are loaded for all posts at once, comments_limit keeps only the first comments of each post
+    session = session if session is not None else db.session
+    relations = {}
+    if "medium_to_post" in include:
+        relations["medium_to_post"] = {}
+        if post_ids:
+            post_media = session.execute(
+                db.select(Media.post_id, Media.url).where(Media.post_id.in_(post_ids))).all()
+            relations["medium_to_post"] = {post_id: url for post_id, url in post_media}
+    if "comments" in include:
+        comments = {post_id: [] for post_id in post_ids}
+        if post_ids:
+            comments_query = db.select(Comments.id, Comments.body, Comments.user_id, Comments.post_id,
+                                       db.func.row_number().over(partition_by=Comments.post_id,
+                                                                 order_by=Comments.id).label("position")
+                                       ).where(Comments.post_id.in_(post_ids)).subquery()
+            post_comments = db.select(comments_query).order_by(comments_query.c.post_id, comments_query.c.id)
+            if comments_limit:
+                post_comments = post_comments.where(comments_query.c.position <= comments_limit)
+            for row in session.execute(post_comments).all():
+                comments[row.post_id].append({"id": row.id,
+                                              "body": row.body,
+                                              "user_id": row.user_id,
+                                              "post_id": row.post_id})
+        relations["comments"] = {post_id: rows if rows else None for post_id, rows in comments.items()}
+    return relations
+
+
+def serialize_users(users, session=None):
+    relations = load_user_relations([user.id for user in users], session=session)
+    return [{"id": user.id,
+             "email": user.email,
+             "is_active": user.is_active,
+             "is_admin": user.is_admin,
+             "first_name": user.first_name,
+             "last_name": user.last_name,
+             "follower_count": user.follower_count,
+             "following_count": user.following_count,
+             "post_count": user.post_count,
+             "followers": relations["followers"][user.id],
+             "following": relations["following"][user.id],
+             "posts": relations["posts"][user.id],
+             "comments": relations["comments"][user.id]} for user in users]
+
+
+def serialize_posts(posts, comments_limit=None, session=None):
+    relations = load_post_relations([post.id for post in posts], comments_limit=comments_limit, session=session)
+    return [{"id": post.id,
+             "title": post.title,
+             "description": post.description,
+             "body": post.body,
+             "date": post.date.strftime("%d-%m-%Y"),
+             "medium_to_post": relations["medium_to_post"].get(post.id),
+             "comments": relations["comments"][post.id],
+             "comment_count": post.comment_count,
+             "user_id": post.user_id} for post in posts]
@@ -0,0 +1,55 @@
+"""
+This module takes care of the keyset (cursor) pagination shared by the listing endpoints
+"""
+import base64
+import json
+from datetime import date
+from flask import request, current_app
+
+
+# JSON types of the cursor fields, any other field is an integer id
+FIELD_TYPES = {"date": str, "score": (int, float), "kind": str}
+
+
+def encode_cursor(values):
+    if not values:
+        return None
+    payload = json.dumps(values, separators=(",", ":"), default=str).encode()
+    return base64.urlsafe_b64encode(payload).decode().rstrip("=")
+
+
+def decode_cursor(cursor, fields, partial=False):
+    # Cursors are opaque to clients, anything that does not decode to the expected fields is a ValueError
+    padding = "=" * (-len(cursor) % 4)
+    values = json.loads(base64.urlsafe_b64decode(cursor + padding))
+    if not isinstance(values, dict):
+        raise ValueError(f"Invalid cursor {cursor}")
+    if not set(values) <= set(fields) or (not partial and set(values) != set(fields)):
+        raise ValueError(f"Invalid cursor {cursor}")
+    for field, value in values.items():
+        if not isinstance(value, FIELD_TYPES.get(field, int)) or isinstance(value, bool):
+            raise ValueError(f"Invalid cursor {cursor}")
+        if field == "date":
+            values[field] = date.fromisoformat(value)
+    return values
+
+
+def get_page_args(*fields, partial=False):
+    return parse_page_args(request.args, current_app.config, *fields, partial=partial)
+
+
+def parse_page_args(args, config, *fields, partial=False):
+    default_limit = config.get("PAGE_DEFAULT_LIMIT", 20)
+    max_limit = config.get("PAGE_MAX_LIMIT", 100)
+    limit = args.get("limit", default_limit, type=int)
+    if limit < 1:
+        raise ValueError(f"Invalid limit {limit}")
+    cursor = args.get("cursor", None)
+    return min(limit, max_limit), decode_cursor(cursor, fields, partial) if cursor else None
+
+
+def split_page(rows, limit):
+    # Listings fetch limit + 1 rows, the extra row only tells whether there is a next page
+    if len(rows) > limit:
+        return rows[:limit], rows[limit - 1]
+    return rows, None
@@ -0,0 +1,111 @@
+"""
+This module takes care of routing reads to replicas. SELECT statements of GET requests go to one of the
+binds listed in SQLALCHEMY_READ_REPLICAS, chosen round robin or by least checked out connections, and
+everything else goes to the primary. After a commit the user keeps reading from the primary during
+READ_YOUR_WRITES_WINDOW seconds, so nobody misses their own writes because of replication lag. The last
+writes are kept in a backend of api.cache, set READ_YOUR_WRITES_BACKEND to "redis" when several workers
+serve the same users, otherwise a write is only seen by the worker that made it
+"""
+import itertools
+import threading
+from flask import current_app, g, request, has_request_context
+from flask_jwt_extended import get_jwt
+from flask_sqlalchemy.session import Session
+from api.cache import LRUBackend, RedisBackend
+
+
+class ReplicaRouter:
+
+    def __init__(self, replicas, backend, strategy="round_robin"):
+        # backend is a LRUBackend or a RedisBackend whose ttl is the read-your-writes window
+        self.replicas = list(replicas)
+        self.backend = backend
+        self.strategy = strategy
+        self.cycle = itertools.cycle(self.replicas)
+        self.lock = threading.Lock()
+
+    def choose(self, engines):
+        if self.strategy == "least_connections":
+            return min(self.replicas, key=lambda bind_key: checked_out(engines[bind_key]))
+        with self.lock:
+            return next(self.cycle)
+
+    def record_write(self, user_id):
+        # The entry expires with the backend ttl, so the window starts again with every commit
+        self.backend.set(f"writer:{user_id}", True, f"writer:{user_id}")
+
+    def wrote_recently(self, user_id):
+        return self.backend.get(f"writer:{user_id}") is not None
+
+
+def checked_out(engine):
+    checkedout = getattr(engine.pool, "checkedout", None)
+    return checkedout() if checkedout else 0
+
+
+def get_replica_router():
+    if "replica_router" not in current_app.extensions:
+        replicas = current_app.config.get("SQLALCHEMY_READ_REPLICAS", [])
+        router = None
+        if replicas:
+            backend = current_app.config.get("READ_YOUR_WRITES_BACKEND", "lru")
+            window = current_app.config.get("READ_YOUR_WRITES_WINDOW", 5)
+            if backend == "lru":
+                backend = LRUBackend(current_app.config.get("READ_YOUR_WRITES_MAX_ENTRIES", 100000), window)
+            elif backend == "redis":
+                backend = RedisBackend(current_app.config["READ_YOUR_WRITES_REDIS_URL"], window, "api-writes:")
+            router = ReplicaRouter(replicas, backend, current_app.config.get("REPLICA_STRATEGY", "round_robin"))
+        current_app.extensions["replica_router"] = router
+    return current_app.extensions["replica_router"]
+
+
+def get_token_user_id():
+    try:
+        return get_jwt().get("user_id", None)
+    except RuntimeError:
+        return None
+
+
+class RoutingSession(Session):
+
+    def get_bind(self, mapper=None, clause=None, bind=None, **kwargs):
+        if bind is not None or not has_request_context():
+            return super().get_bind(mapper, clause=clause, bind=bind, **kwargs)
+        router = get_replica_router()
+        if router is None:
+            return super().get_bind(mapper, clause=clause, bind=bind, **kwargs)
+        is_read = clause is not None and getattr(clause, "is_select", False) and not self._flushing
+        if not is_read:
+            g.db_primary = True
+            if request.method not in ("GET", "HEAD"):
+                # Recorded by commit, a rolled back write has nothing to read back
+                g.db_wrote = True
+        if is_read and request.method in ("GET", "HEAD") and not g.get("db_primary", False):
+            user_id = get_token_user_id()
+            if not user_id or not router.wrote_recently(user_id):
+                # The replica is chosen once per request, so a request reads from a single snapshot
+                if "db_replica" not in g:
+                    g.db_replica = router.choose(self._db.engines)
+                return self._db.engines[g.db_replica]
+        return super().get_bind(mapper, clause=clause, bind=bind, **kwargs)
+
+    def commit(self):
+        super().commit()
+        if has_request_context() and g.pop("db_wrote", False):
+            router = get_replica_router()
+            user_id = get_token_user_id()
+            if router is not None and user_id:
+                router.record_write(user_id)
+
+
+def pool_metrics(engines):
+    metrics = {}
+    for bind_key, engine in engines.items():
+        pool = engine.pool
+        metrics[bind_key or "primary"] = {
+            "pool": type(pool).__name__,
+            "size": pool.size() if hasattr(pool, "size") else None,
+            "checked_in": pool.checkedin() if hasattr(pool, "checkedin") else None,
+            "checked_out": pool.checkedout() if hasattr(pool, "checkedout") else None,
+            "overflow": pool.overflow() if hasattr(pool, "overflow") else None}
+    return metrics
@@ -1,12 +1,28 @@
 """
 This module takes care of starting the API Server, Loading the DB and Adding the endpoints
 """
-from flask import Flask, request, jsonify, url_for, Blueprint
+from flask import Flask, request, jsonify, url_for, Blueprint, current_app, Response, stream_with_context
 from api.utils import generate_sitemap, APIException
 from flask_cors import CORS
-from api.models import db, Users, Followers, Posts, Media, Comments
+from api.models import db, Users, Followers, Posts, Media, Comments, dialect_insert
+from api.feed import fan_out_posts, backfill_timeline, remove_from_timeline, get_feed
+from api.pagination import get_page_args, split_page, encode_cursor
+from api.counters import count_follows, count_posts, count_comments
+from api.cache import cached, invalidate
+from api.instrumentation import init_instrumentation
+from api.graph import get_follow_graph, contains, FOLLOWING
+from api.export import iter_account_records, iter_ndjson, iter_gzip
+from api.serializers import UserSerializer, PostSerializer, build_claims
+from api.batch import run_batch
+from api.search import search, index_documents, post_document, comment_document
+from api.replicas import pool_metrics
+from api.ingest import get_comment_queue
+from api.entities import get_entity_cache
+from api.trending import record_engagement, get_trending
+from api.encoders import init_encoders, compress_response
+import queue
 import requests
-from sqlalchemy import asc
+from sqlalchemy import asc, and_, or_, delete, insert, literal
 from flask_jwt_extended import create_access_token
 from flask_jwt_extended import get_jwt_identity
 from flask_jwt_extended import jwt_required
@@ -18,6 +34,35 @@ api = Blueprint("api", __name__)
 CORS(api)  # Allow CORS requests to this API
 
 
+@api.record_once
+def setup_api(state):
+    # The encoders go first so the instrumentation times them too
+    init_encoders(state.app)
+    init_instrumentation(state.app)
+
+
+api.after_request(compress_response)
+
+
+def get_batch_items(data):
+    items = data.get("items", None) if isinstance(data, dict) else None
+    if not isinstance(items, list) or not items:
+        return None
+    if len(items) > current_app.config.get("BATCH_MAX_ITEMS", 1000):
+        return None
+    return items
+
+
+def find_invalid_text(item, model, names):
+    # First field of item that is neither null nor a string fitting its column, None when all of them fit
+    for name in names:
+        value = item.get(name, None)
+        length = model.__table__.c[name].type.length
+        if value is not None and (not isinstance(value, str) or (length and len(value) > length)):
+            return name
+    return None
+
+
 # Signup access token
 @api.route("/signup", methods=["POST"])
 def signup():
@@ -39,21 +84,12 @@ def signup():
     db.session.add(user)
     db.session.commit()
 
-    claims = {"user_id": user.id,
-              "email": user.email,
-              "is_active": user.is_active,
-              "is_admin": user.is_admin,
-              "first_name": user.first_name if user.first_name else None,
-              "last_name": user.last_name if user.last_name else None,
-              "followers": [],
-              "following": [],
-              "posts": [],
-              "comments": []}
-
+    results = user.serialize()
+    claims = build_claims(results)
     access_token = create_access_token(
         identity=user.email, additional_claims=claims)
     response_body["message"] = f"User {user.id} posted successfully"
-    response_body["results"] = user.serialize()
+    response_body["results"] = results
     response_body["access_token"] = access_token
     return jsonify(response_body), 201
 
@@ -77,27 +113,19 @@ def login():
         response_body["results"] = None
         return jsonify(response_body), 403
 
-    claims = {"user_id": user.id,
-              "email": user.email,
-              "is_active": user.is_active,
-              "is_admin": user.is_admin,
-              "first_name": user.first_name if user.first_name else None,
-              "last_name": user.last_name if user.last_name else None,
-              "followers": [row.serialize()["follower_id"] for row in user.following_to] if user.following_to else [],
-              "following": [row.serialize()["following_id"] for row in user.follower_to] if user.follower_to else [],
-              "posts": [row.serialize()["id"] for row in user.user_posts] if user.user_posts else [],
-              "comments": [row.serialize() for row in user.user_comments] if user.user_comments else []}
-
+    results = user.serialize()
+    claims = build_claims(results)
     access_token = create_access_token(
         identity=email, additional_claims=claims)
     response_body["message"] = f"User {user.email} logged successfully"
-    response_body["results"] = user.serialize()
+    response_body["results"] = results
     response_body["access_token"] = access_token
     return jsonify(response_body), 200
 
 
 @api.route("/users/<int:user_id>", methods=["GET", "PUT", "DELETE"])
 @jwt_required()
+@cached("user", "user_id")
 def handle_user(user_id):
     response_body = {}
     claims = get_jwt()
@@ -106,13 +134,22 @@ def handle_user(user_id):
         response_body["message"] = "Current user not found"
         response_body["results"] = None
         return jsonify(response_body), 401
-    user_to_handle = db.session.execute(db.select(Users).where(Users.id == user_id)).scalar()
+    user_query = db.select(Users)
+    if request.method == "GET":
+        try:
+            serializer = UserSerializer.from_args(request.args)
+        except ValueError as error:
+            response_body["message"] = str(error)
+            response_body["results"] = None
+            return jsonify(response_body), 400
+        user_query = serializer.select()
+    user_to_handle = db.session.execute(user_query.where(Users.id == user_id)).scalar()
     if not user_to_handle:
         response_body["message"] = f"User {user_id} not found"
         response_body["results"] = None
         return jsonify(response_body), 404
     if request.method == "GET":
-        results = user_to_handle.serialize()
+        results = serializer.dump([user_to_handle])[0]
         response_body["message"] = f"User {user_id} got successfully"
         response_body["results"] = results
         return jsonify(response_body), 200
@@ -126,6 +163,8 @@ def handle_user(user_id):
         user_to_handle.first_name = data.get("first_name", user_to_handle.first_name)
         user_to_handle.last_name = data.get("last_name", user_to_handle.last_name)
         db.session.commit()
+        invalidate("user", user_id)
+        get_entity_cache().invalidate("user", user_id)
         response_body["message"] = f"User {user_to_handle.id} put successfully"
         response_body["results"] = user_to_handle.serialize()
         return jsonify(response_body), 200
@@ -136,11 +175,64 @@ def handle_user(user_id):
             return jsonify(response_body), 403
         user_to_handle.is_active = False
         db.session.commit()
+        invalidate("user", user_id)
+        get_entity_cache().invalidate("user", user_id)
         response_body["message"] = f"User {user_to_handle.id} deleted successfully"
         response_body["results"] = None
         return jsonify(response_body), 200
 
 
+@api.route("/users/<int:user_id>/counts", methods=["GET"])
+@jwt_required()
+def handle_user_counts(user_id):
+    response_body = {}
+    claims = get_jwt()
+    token_user_id = claims["user_id"]
+    if not token_user_id:
+        response_body["message"] = "Current user not found"
+        response_body["results"] = None
+        return jsonify(response_body), 401
+    counts = db.session.execute(db.select(Users.follower_count,
+                                          Users.following_count,
+                                          Users.post_count).where(Users.id == user_id)).first()
+    if not counts:
+        response_body["message"] = f"User {user_id} not found"
+        response_body["results"] = None
+        return jsonify(response_body), 404
+    response_body["message"] = f"Counts of user {user_id} got successfully"
+    response_body["results"] = {"follower_count": counts.follower_count,
+                                "following_count": counts.following_count,
+                                "post_count": counts.post_count}
+    return jsonify(response_body), 200
+
+
+@api.route("/users/<int:user_id>/export", methods=["GET"])
+@jwt_required()
+def handle_user_export(user_id):
+    response_body = {}
+    claims = get_jwt()
+    token_user_id = claims["user_id"]
+    if not token_user_id:
+        response_body["message"] = "Current user not found"
+        response_body["results"] = None
+        return jsonify(response_body), 401
+    if token_user_id != user_id and not claims["is_admin"]:
+        response_body["message"] = f"User {token_user_id} is not allowed to export {user_id}"
+        response_body["results"] = None
+        return jsonify(response_body), 403
+    user_exists = get_entity_cache().get_user(user_id)
+    if not user_exists:
+        response_body["message"] = f"User {user_id} not found"
+        response_body["results"] = None
+        return jsonify(response_body), 404
+    chunks = iter_ndjson(iter_account_records(user_id))
+    headers = {"Content-Disposition": f"attachment; filename=user-{user_id}.ndjson"}
+    if request.args.get("gzip", "false").lower() in ["1", "true"]:
+        chunks = iter_gzip(chunks)
+        headers["Content-Encoding"] = "gzip"
+    return Response(stream_with_context(chunks), mimetype="application/x-ndjson", headers=headers)
+
+
 @api.route("/users/<int:user_id>/favorites", methods=["GET"])
 @jwt_required()
 def handle_favorites(user_id):
@@ -151,7 +243,7 @@ def handle_favorites(user_id):
         response_body["message"] = "Current user not found"
         response_body["results"] = None
         return jsonify(response_body), 401
-    user_to_handle = db.session.execute(db.select(Users).where(Users.id == user_id)).scalar()
+    user_to_handle = get_entity_cache().get_user(user_id)
     if not user_to_handle:
         response_body["message"] = f"User {user_id} not found"
         response_body["results"] = None
@@ -187,10 +279,33 @@ def handle_followers():
         response_body["results"] = None
         return jsonify(response_body), 401
     if request.method == "GET":
-        followers = db.session.execute(db.select(Followers).where(
-            Followers.following_id == token_user_id)).scalars()
-        following = db.session.execute(db.select(Followers).where(
-            Followers.follower_id == token_user_id)).scalars()
+        # The cursor keeps one position per list, a list missing from a given cursor is already exhausted
+        try:
+            limit, cursor = get_page_args("followers", "following", partial=True)
+        except ValueError:
+            response_body["message"] = "Invalid pagination parameters"
+            response_body["results"] = None
+            return jsonify(response_body), 400
+        next_cursor = {}
+        followers = []
+        following = []
+        if not cursor or "followers" in cursor:
+            followers_query = (db.select(Followers).where(Followers.following_id == token_user_id)
+                               .order_by(Followers.follower_id).limit(limit + 1))
+            if cursor:
+                followers_query = followers_query.where(Followers.follower_id > cursor["followers"])
+            followers, last = split_page(db.session.execute(followers_query).scalars().all(), limit)
+            if last:
+                next_cursor["followers"] = last.follower_id
+        if not cursor or "following" in cursor:
+            following_query = (db.select(Followers).where(Followers.follower_id == token_user_id)
+                               .order_by(Followers.following_id).limit(limit + 1))
+            if cursor:
+                following_query = following_query.where(Followers.following_id > cursor["following"])
+            following, last = split_page(db.session.execute(following_query).scalars().all(), limit)
+            if last:
+                next_cursor["following"] = last.following_id
+        response_body["next_cursor"] = encode_cursor(next_cursor)
         if not followers and not following:
             response_body["message"] = f"User {token_user_id} does not follow or is followed by anyone"
             response_body["results"] = {"following": [],
@@ -217,29 +332,177 @@ def handle_followers():
     if request.method == "POST":
         data = request.json
         following_id = data.get("following_id", None)
-        follow_exists = db.session.execute(
-            db.select(Users).where(Users.id == following_id)).scalar()
-        if not follow_exists:
-            response_body["message"] = f"User {following_id} not found"
+        if not isinstance(following_id, int) or isinstance(following_id, bool):
+            response_body["message"] = "following_id must be an integer"
             response_body["results"] = None
-            return jsonify(response_body), 404
-        already_following = db.session.execute(db.select(Followers).where(Followers.follower_id == token_user_id,
-                                                                          Followers.following_id == following_id)).scalar()
-        if already_following:
+            return jsonify(response_body), 400
+        # A single INSERT ... SELECT ... ON CONFLICT DO NOTHING, it only inserts if the user exists and
+        # the unique (follower_id, following_id) index makes concurrent follows race free
+        follow_target = db.select(literal(token_user_id), Users.id).where(Users.id == following_id)
+        follower = db.session.execute(
+            dialect_insert(Followers)
+            .from_select(["follower_id", "following_id"], follow_target)
+            .on_conflict_do_nothing(index_elements=["follower_id", "following_id"])
+            .returning(Followers.id, Followers.following_id, Followers.follower_id)).first()
+        if not follower:
+            follow_exists = get_entity_cache().get_user(following_id)
+            if not follow_exists:
+                response_body["message"] = f"User {following_id} not found"
+                response_body["results"] = None
+                return jsonify(response_body), 404
             response_body["message"] = f"User {token_user_id} is already following {following_id}"
             response_body["results"] = None
             return jsonify(response_body), 409
-        follower = Followers()
-        follower.follower_id = token_user_id
-        follower.following_id = following_id
-        db.session.add(follower)
+        backfill_timeline(token_user_id, [following_id])
+        count_follows(token_user_id, [following_id])
         db.session.commit()
-        results = follower.serialize()
+        invalidate("user", token_user_id, following_id)
+        get_follow_graph().add_edge(token_user_id, following_id)
+        results = {"id": follower.id,
+                   "following_id": follower.following_id,
+                   "follower_id": follower.follower_id}
         response_body["message"] = f"User {token_user_id} now follows user {following_id}"
         response_body["results"] = results
         return jsonify(response_body), 201
 
 
+@api.route("/followers/batch", methods=["POST"])
+@jwt_required()
+def handle_followers_batch():
+    response_body = {}
+    claims = get_jwt()
+    token_user_id = claims["user_id"]
+    if not token_user_id:
+        response_body["message"] = "Current user not found"
+        response_body["results"] = None
+        return jsonify(response_body), 401
+    items = get_batch_items(request.json)
+    if not items:
+        response_body["message"] = f"Batch must be a non empty list of at most {current_app.config.get('BATCH_MAX_ITEMS', 1000)} items"
+        response_body["results"] = None
+        return jsonify(response_body), 400
+    following_ids = [item.get("following_id", None) if isinstance(item, dict) else None for item in items]
+    following_ids = [following_id if isinstance(following_id, int) else None for following_id in following_ids]
+    requested_ids = {following_id for following_id in following_ids if following_id is not None}
+    # One IN query per check, then a single executemany insert for the whole batch
+    existing_users = set(get_entity_cache().get_users(requested_ids))
+    already_following = set(db.session.execute(
+        db.select(Followers.following_id).where(Followers.follower_id == token_user_id,
+                                                Followers.following_id.in_(requested_ids))).scalars())
+    new_ids = sorted(existing_users - already_following)
+    created = {}
+    if new_ids:
+        inserted = db.session.execute(
+            dialect_insert(Followers)
+            .on_conflict_do_nothing(index_elements=["follower_id", "following_id"])
+            .returning(Followers.id, Followers.following_id, Followers.follower_id),
+            [{"follower_id": token_user_id, "following_id": following_id} for following_id in new_ids]).all()
+        created = {row.following_id: row for row in inserted}
+        if created:
+            backfill_timeline(token_user_id, list(created))
+            count_follows(token_user_id, list(created))
+    db.session.commit()
+    invalidate("user", token_user_id, *created)
+    for following_id in created:
+        get_follow_graph().add_edge(token_user_id, following_id)
+    results = []
+    for position, following_id in enumerate(following_ids):
+        if following_id is None:
+            results.append({"status": 400,
+                            "message": f"Item {position} is not a follow",
+                            "results": None})
+        elif following_id not in existing_users:
+            results.append({"status": 404,
+                            "message": f"User {following_id} not found",
+                            "results": None})
+        elif following_id in created:
+            follower = created.pop(following_id)
+            results.append({"status": 201,
+                            "message": f"User {token_user_id} now follows user {following_id}",
+                            "results": {"id": follower.id,
+                                        "following_id": follower.following_id,
+                                        "follower_id": follower.follower_id}})
+        else:
+            results.append({"status": 409,
+                            "message": f"User {token_user_id} is already following {following_id}",
+                            "results": None})
+    response_body["message"] = f"User {token_user_id} batch of {len(items)} follows processed"
+    response_body["results"] = results
+    return jsonify(response_body), 200
+
+
+@api.route("/followers/mutual", methods=["GET"])
+@jwt_required()
+def handle_mutual_followers():
+    response_body = {}
+    claims = get_jwt()
+    token_user_id = claims["user_id"]
+    if not token_user_id:
+        response_body["message"] = "Current user not found"
+        response_body["results"] = None
+        return jsonify(response_body), 401
+    results = get_follow_graph().mutual(token_user_id)
+    if not results:
+        response_body["message"] = f"User {token_user_id} has no mutual followers"
+        response_body["results"] = []
+        return jsonify(response_body), 200
+    response_body["message"] = f"Mutual followers of user {token_user_id} got successfully"
+    response_body["results"] = results
+    return jsonify(response_body), 200
+
+
+@api.route("/followers/check", methods=["POST"])
+@jwt_required()
+def handle_followers_check():
+    response_body = {}
+    claims = get_jwt()
+    token_user_id = claims["user_id"]
+    if not token_user_id:
+        response_body["message"] = "Current user not found"
+        response_body["results"] = None
+        return jsonify(response_body), 401
+    items = get_batch_items(request.json)
+    if not items:
+        response_body["message"] = f"Batch must be a non empty list of at most {current_app.config.get('BATCH_MAX_ITEMS', 1000)} items"
+        response_body["results"] = None
+        return jsonify(response_body), 400
+    follow_graph = get_follow_graph()
+    pairs = [(item.get("follower_id", None), item.get("following_id", None)) if isinstance(item, dict) else (None, None)
+             for item in items]
+    follower_ids = {follower_id for follower_id, following_id in pairs if isinstance(follower_id, int)}
+    following = follow_graph.load(FOLLOWING, list(follower_ids))
+    results = []
+    for follower_id, following_id in pairs:
+        if not isinstance(follower_id, int) or not isinstance(following_id, int):
+            results.append(None)
+            continue
+        results.append(contains(following[follower_id], following_id))
+    response_body["message"] = f"Batch of {len(items)} follow checks processed"
+    response_body["results"] = results
+    return jsonify(response_body), 200
+
+
+@api.route("/followers/suggestions", methods=["GET"])
+@jwt_required()
+def handle_follow_suggestions():
+    response_body = {}
+    claims = get_jwt()
+    token_user_id = claims["user_id"]
+    if not token_user_id:
+        response_body["message"] = "Current user not found"
+        response_body["results"] = None
+        return jsonify(response_body), 401
+    limit = min(max(request.args.get("limit", 20, type=int), 1), current_app.config.get("PAGE_MAX_LIMIT", 100))
+    suggestions = get_follow_graph().suggestions(token_user_id, limit)
+    if not suggestions:
+        response_body["message"] = f"There are no suggestions for user {token_user_id}"
+        response_body["results"] = []
+        return jsonify(response_body), 200
+    response_body["message"] = f"Suggestions for user {token_user_id} got successfully"
+    response_body["results"] = [{"user_id": user_id, "followed_by": overlap} for user_id, overlap in suggestions]
+    return jsonify(response_body), 200
+
+
 @api.route("/followers/<int:following_id>", methods=["DELETE"])
 @jwt_required()
 def handle_follower(following_id):
@@ -250,15 +513,21 @@ def handle_follower(following_id):
         response_body["message"] = "Current user not found"
         response_body["results"] = None
         return jsonify(response_body), 404
-    following_user = db.session.execute(db.select(Followers).where(Followers.follower_id == token_user_id,
-                                                                   Followers.following_id == following_id)).scalar()
-    if not following_user:
-        response_body["message"] = f"Following user {following_id} not found"
-        response_body["results"] = None
-        return jsonify(response_body), 404
     if request.method == "DELETE":
-        db.session.delete(following_user)
+        following_user = db.session.execute(
+            delete(Followers)
+            .where(Followers.follower_id == token_user_id,
+                   Followers.following_id == following_id)
+            .returning(Followers.id)).first()
+        if not following_user:
+            response_body["message"] = f"Following user {following_id} not found"
+            response_body["results"] = None
+            return jsonify(response_body), 404
+        remove_from_timeline(token_user_id, following_id)
+        count_follows(token_user_id, [following_id], delta=-1)
         db.session.commit()
+        invalidate("user", token_user_id, following_id)
+        get_follow_graph().remove_edge(token_user_id, following_id)
         response_body["message"] = f"Following user {following_id} deleted successfully"
         response_body["results"] = None
         return jsonify(response_body), 200
@@ -275,13 +544,32 @@ def handle_posts():
         response_body["results"] = None
         return jsonify(response_body), 401
     if request.method == "GET":
-        posts = db.session.execute(db.select(Posts).where(
-            Posts.user_id == token_user_id)).scalars().all()
+        try:
+            limit, cursor = get_page_args("date", "id")
+        except ValueError:
+            response_body["message"] = "Invalid pagination parameters"
+            response_body["results"] = None
+            return jsonify(response_body), 400
+        try:
+            serializer = PostSerializer.from_args(
+                request.args, comments_limit=current_app.config.get("POSTS_COMMENTS_PREVIEW", 3))
+        except ValueError as error:
+            response_body["message"] = str(error)
+            response_body["results"] = None
+            return jsonify(response_body), 400
+        posts_query = (serializer.select().where(Posts.user_id == token_user_id)
+                       .order_by(Posts.date.desc(), Posts.id.desc()).limit(limit + 1))
+        if cursor:
+            posts_query = posts_query.where(or_(
+                Posts.date < cursor["date"],
+                and_(Posts.date == cursor["date"], Posts.id < cursor["id"])))
+        posts, last = split_page(db.session.execute(posts_query).scalars().all(), limit)
+        response_body["next_cursor"] = encode_cursor({"date": last.date, "id": last.id} if last else None)
         if not posts:
             response_body["message"] = f"User {token_user_id} has not posted anything yet"
             response_body["results"] = []
             return jsonify(response_body), 200
-        results = [row.serialize() for row in posts]
+        results = serializer.dump(posts)
         response_body["message"] = f"Posts from user {token_user_id} got successfully"
         response_body["results"] = results
         return jsonify(response_body), 200
@@ -299,15 +587,163 @@ def handle_posts():
         post.date = date
         post.user_id = user_id
         db.session.add(post)
+        db.session.flush()
+        fan_out_posts([post.id])
+        count_posts(token_user_id, 1)
+        index_documents([post_document(post.id, title, description, body)])
         db.session.commit()
+        invalidate("user", token_user_id)
+        get_entity_cache().invalidate("post", post.id)
         results = post.serialize()
         response_body["message"] = f"User {token_user_id} posted a new post"
         response_body["results"] = results
         return jsonify(response_body), 201
 
 
+@api.route("/posts/trending", methods=["GET"])
+@jwt_required()
+def handle_trending():
+    response_body = {}
+    claims = get_jwt()
+    token_user_id = claims["user_id"]
+    if not token_user_id:
+        response_body["message"] = "Current user not found"
+        response_body["results"] = None
+        return jsonify(response_body), 401
+    try:
+        limit, cursor = get_page_args("position")
+    except ValueError:
+        response_body["message"] = "Invalid pagination parameters"
+        response_body["results"] = None
+        return jsonify(response_body), 400
+    try:
+        serializer = PostSerializer.from_args(
+            request.args, comments_limit=current_app.config.get("POSTS_COMMENTS_PREVIEW", 3))
+    except ValueError as error:
+        response_body["message"] = str(error)
+        response_body["results"] = None
+        return jsonify(response_body), 400
+    # The ranking is precomputed, a page is a slice of it and only its posts are loaded
+    position = max(cursor["position"], 0) if cursor else 0
+    ranked, last = split_page(get_trending().get_ranking()[position:position + limit + 1], limit)
+    response_body["next_cursor"] = encode_cursor({"position": position + limit} if last else None)
+    scores = dict(ranked)
+    posts = db.session.execute(serializer.select().where(Posts.id.in_(scores))).scalars().all()
+    posts = sorted(posts, key=lambda post: (-scores[post.id], -post.id))
+    if not posts:
+        response_body["message"] = "There are no trending posts"
+        response_body["results"] = []
+        return jsonify(response_body), 200
+    results = serializer.dump(posts)
+    for result, post in zip(results, posts):
+        result["trending_score"] = round(scores[post.id], 3)
+    response_body["message"] = "Trending posts got successfully"
+    response_body["results"] = results
+    return jsonify(response_body), 200
+
+
+@api.route("/feed", methods=["GET"])
+@jwt_required()
+def handle_feed():
+    response_body = {}
+    claims = get_jwt()
+    token_user_id = claims["user_id"]
+    if not token_user_id:
+        response_body["message"] = "Current user not found"
+        response_body["results"] = None
+        return jsonify(response_body), 401
+    try:
+        limit, cursor = get_page_args("date", "id")
+    except ValueError:
+        response_body["message"] = "Invalid pagination parameters"
+        response_body["results"] = None
+        return jsonify(response_body), 400
+    try:
+        serializer = PostSerializer.from_args(
+            request.args, comments_limit=current_app.config.get("POSTS_COMMENTS_PREVIEW", 3))
+    except ValueError as error:
+        response_body["message"] = str(error)
+        response_body["results"] = None
+        return jsonify(response_body), 400
+    posts, next_cursor = get_feed(token_user_id, limit, cursor, serializer.select())
+    response_body["next_cursor"] = encode_cursor(next_cursor)
+    if not posts:
+        response_body["message"] = f"Feed of user {token_user_id} is empty"
+        response_body["results"] = []
+        return jsonify(response_body), 200
+    results = serializer.dump(posts)
+    response_body["message"] = f"Feed of user {token_user_id} got successfully"
+    response_body["results"] = results
+    return jsonify(response_body), 200
+
+
+@api.route("/posts/batch", methods=["POST"])
+@jwt_required()
+def handle_posts_batch():
+    response_body = {}
+    claims = get_jwt()
+    token_user_id = claims["user_id"]
+    if not token_user_id:
+        response_body["message"] = "Current user not found"
+        response_body["results"] = None
+        return jsonify(response_body), 401
+    items = get_batch_items(request.json)
+    if not items:
+        response_body["message"] = f"Batch must be a non empty list of at most {current_app.config.get('BATCH_MAX_ITEMS', 1000)} items"
+        response_body["results"] = None
+        return jsonify(response_body), 400
+    date = datetime.now().date()
+    results = [None] * len(items)
+    rows = []
+    positions = []
+    for position, item in enumerate(items):
+        if not isinstance(item, dict):
+            results[position] = {"status": 400,
+                                 "message": f"Item {position} is not a post",
+                                 "results": None}
+            continue
+        invalid = find_invalid_text(item, Posts, ("title", "description", "body"))
+        if invalid:
+            results[position] = {"status": 400,
+                                 "message": f"Item {position} has an invalid {invalid}",
+                                 "results": None}
+            continue
+        rows.append({"title": item.get("title", None),
+                     "description": item.get("description", None),
+                     "body": item.get("body", None),
+                     "date": date,
+                     "user_id": token_user_id})
+        positions.append(position)
+    if rows:
+        post_ids = db.session.execute(
+            insert(Posts).returning(Posts.id, sort_by_parameter_order=True), rows).scalars().all()
+        fan_out_posts(post_ids)
+        count_posts(token_user_id, len(post_ids))
+        index_documents([post_document(post_id, row["title"], row["description"], row["body"])
+                         for post_id, row in zip(post_ids, rows)])
+        db.session.commit()
+        invalidate("user", token_user_id)
+        get_entity_cache().invalidate("post", *post_ids)
+        for position, post_id, row in zip(positions, post_ids, rows):
+            results[position] = {"status": 201,
+                                 "message": f"User {token_user_id} posted a new post",
+                                 "results": {"id": post_id,
+                                             "title": row["title"],
+                                             "description": row["description"],
+                                             "body": row["body"],
+                                             "date": date.strftime("%d-%m-%Y"),
+                                             "medium_to_post": None,
+                                             "comments": None,
+                                             "comment_count": 0,
+                                             "user_id": token_user_id}}
+    response_body["message"] = f"User {token_user_id} batch of {len(items)} posts processed"
+    response_body["results"] = results
+    return jsonify(response_body), 200
+
+
 @api.route("/posts/<int:post_id>/comments", methods=["GET", "POST"])
 @jwt_required()
+@cached("comments", "post_id")
 def handle_comments(post_id):
     response_body = {}
     claims = get_jwt()
@@ -316,15 +752,24 @@ def handle_comments(post_id):
         response_body["message"] = "Current user not found"
         response_body["results"] = None
         return jsonify(response_body), 401
-    post_exists = db.session.execute(
-        db.select(Posts).where(Posts.id == post_id)).scalar()
+    post_exists = get_entity_cache().get_post(post_id)
     if not post_exists:
         response_body["message"] = f"Post {post_id} not found"
         response_body["results"] = None
         return jsonify(response_body), 404
     if request.method == "GET":
-        comments = db.session.execute(db.select(Comments).where(
-            Comments.post_id == post_id)).scalars().all()
+        try:
+            limit, cursor = get_page_args("id")
+        except ValueError:
+            response_body["message"] = "Invalid pagination parameters"
+            response_body["results"] = None
+            return jsonify(response_body), 400
+        comments_query = (db.select(Comments).where(Comments.post_id == post_id)
+                          .order_by(Comments.id).limit(limit + 1))
+        if cursor:
+            comments_query = comments_query.where(Comments.id > cursor["id"])
+        comments, last = split_page(db.session.execute(comments_query).scalars().all(), limit)
+        response_body["next_cursor"] = encode_cursor({"id": last.id} if last else None)
         if not comments:
             response_body["message"] = f"There are no comments in post {post_id}"
             response_body["results"] = []
@@ -336,20 +781,108 @@ def handle_comments(post_id):
     if request.method == "POST":
         data = request.json
         body = data.get("body", None)
+        if current_app.config.get("COMMENT_INGEST_MODE", None) == "queue":
+            try:
+                comment = get_comment_queue().submit(body, token_user_id, post_id)
+            except ValueError as error:
+                response_body["message"] = str(error)
+                response_body["results"] = None
+                return jsonify(response_body), 400
+            except queue.Full:
+                response_body["message"] = "Too many comments, try again later"
+                response_body["results"] = None
+                return jsonify(response_body), 503, {"Retry-After": "1"}
+            response_body["message"] = f"User {token_user_id} comment in post {post_id} accepted"
+            response_body["results"] = {"provisional_id": comment["ingest_id"],
+                                        "body": body,
+                                        "user_id": token_user_id,
+                                        "post_id": post_id}
+            return jsonify(response_body), 202
         comment = Comments()
         comment.body = body
         comment.user_id = token_user_id
         comment.post_id = post_id
         db.session.add(comment)
+        db.session.flush()
+        count_comments([post_id])
+        record_engagement([post_id], "comments")
+        index_documents([comment_document(comment.id, post_id, body)])
         db.session.commit()
+        invalidate("comments", post_id)
+        invalidate("user", token_user_id)
         results = comment.serialize()
         response_body["message"] = f"User {token_user_id} posted a new comment in post {post_id}"
         response_body["results"] = results
         return jsonify(response_body), 201
 
 
+@api.route("/comments/batch", methods=["POST"])
+@jwt_required()
+def handle_comments_batch():
+    response_body = {}
+    claims = get_jwt()
+    token_user_id = claims["user_id"]
+    if not token_user_id:
+        response_body["message"] = "Current user not found"
+        response_body["results"] = None
+        return jsonify(response_body), 401
+    items = get_batch_items(request.json)
+    if not items:
+        response_body["message"] = f"Batch must be a non empty list of at most {current_app.config.get('BATCH_MAX_ITEMS', 1000)} items"
+        response_body["results"] = None
+        return jsonify(response_body), 400
+    post_ids = {item.get("post_id", None) for item in items
+                if isinstance(item, dict) and isinstance(item.get("post_id", None), int)}
+    existing_posts = set(get_entity_cache().get_posts(post_ids))
+    results = [None] * len(items)
+    rows = []
+    positions = []
+    for position, item in enumerate(items):
+        if not isinstance(item, dict):
+            results[position] = {"status": 400,
+                                 "message": f"Item {position} is not a comment",
+                                 "results": None}
+            continue
+        post_id = item.get("post_id", None)
+        if not isinstance(post_id, int) or post_id not in existing_posts:
+            results[position] = {"status": 404,
+                                 "message": f"Post {post_id} not found",
+                                 "results": None}
+            continue
+        if find_invalid_text(item, Comments, ("body",)):
+            results[position] = {"status": 400,
+                                 "message": f"Item {position} has an invalid body",
+                                 "results": None}
+            continue
+        rows.append({"body": item.get("body", None),
+                     "user_id": token_user_id,
+                     "post_id": post_id})
+        positions.append(position)
+    if rows:
+        comment_ids = db.session.execute(
+            insert(Comments).returning(Comments.id, sort_by_parameter_order=True), rows).scalars().all()
+        count_comments([row["post_id"] for row in rows])
+        record_engagement([row["post_id"] for row in rows], "comments")
+        index_documents([comment_document(comment_id, row["post_id"], row["body"])
+                         for comment_id, row in zip(comment_ids, rows)])
+        db.session.commit()
+        invalidate("comments", *[row["post_id"] for row in rows])
+        invalidate("user", token_user_id)
+        for position, comment_id, row in zip(positions, comment_ids, rows):
+            results[position] = {"status": 201,
+                                 "message": f"User {token_user_id} posted a new comment in post {row['post_id']}",
+                                 "results": {"id": comment_id,
+                                             "body": row["body"],
+                                             "user_id": token_user_id,
+                                             "post_id": row["post_id"]}}
+    response_body["message"] = f"User {token_user_id} batch of {len(items)} comments processed"
+    response_body["results"] = results
+    return jsonify(response_body), 200
+
+
 @api.route("/posts/<int:post_id>/media", methods=["GET", "POST"])
 @jwt_required()
+@cached("media", "post_id")
 def handle_media(post_id):
     response_body = {}
     claims = get_jwt()
@@ -358,8 +891,7 @@ def handle_media(post_id):
         response_body["message"] = "Current user not found"
         response_body["results"] = None
         return jsonify(response_body), 401
-    post_exists = db.session.execute(
-        db.select(Posts).where(Posts.id == post_id)).scalar()
+    post_exists = get_entity_cache().get_post(post_id)
     if not post_exists:
         response_body["message"] = f"Post {post_id} not found"
         response_body["results"] = None
@@ -376,7 +908,7 @@ def handle_media(post_id):
         response_body["results"] = results
         return jsonify(response_body), 200
     if request.method == "POST":
-        post_owner = post_exists.user_id
+        post_owner = post_exists["user_id"]
         user_owns_post = post_owner == token_user_id
         if not user_owns_post:
             response_body["message"] = f"User {token_user_id} is not allowed to add a medium to post {post_id}"
@@ -398,8 +930,137 @@ def handle_media(post_id):
         medium.medium_type = medium_type
         medium.post_id = post_id
         db.session.add(medium)
+        record_engagement([post_id], "media")
         db.session.commit()
+        invalidate("media", post_id)
         results = medium.serialize()
         response_body["message"] = f"User {token_user_id} added a new medium to post {post_id}"
         response_body["results"] = results
         return jsonify(response_body), 201
+
+
+@api.route("/search", methods=["GET"])
+@jwt_required()
+def handle_search():
+    response_body = {}
+    claims = get_jwt()
+    token_user_id = claims["user_id"]
+    if not token_user_id:
+        response_body["message"] = "Current user not found"
+        response_body["results"] = None
+        return jsonify(response_body), 401
+    query = request.args.get("q", "").strip()
+    if not query:
+        response_body["message"] = "Search query q is required"
+        response_body["results"] = None
+        return jsonify(response_body), 400
+    try:
+        limit, cursor = get_page_args("score", "kind", "ref_id")
+    except ValueError:
+        response_body["message"] = "Invalid pagination parameters"
+        response_body["results"] = None
+        return jsonify(response_body), 400
+    hits, last = split_page(search(query, limit, cursor), limit)
+    response_body["next_cursor"] = encode_cursor(
+        {"score": last.score, "kind": last.kind, "ref_id": last.ref_id} if last else None)
+    if not hits:
+        response_body["message"] = f"There are no results for {query}"
+        response_body["results"] = []
+        return jsonify(response_body), 200
+    serializer = PostSerializer(["id", "title", "description", "date", "user_id"], [])
+    post_ids = [hit.ref_id for hit in hits if hit.kind == "post"]
+    comment_ids = [hit.ref_id for hit in hits if hit.kind == "comment"]
+    posts = db.session.execute(serializer.select().where(Posts.id.in_(post_ids))).scalars().all()
+    comments = db.session.execute(db.select(Comments).where(Comments.id.in_(comment_ids))).scalars().all()
+    found = {("post", result["id"]): result for result in serializer.dump(posts)}
+    found.update({("comment", row.id): row.serialize() for row in comments})
+    results = [{"kind": hit.kind, "results": found[(hit.kind, hit.ref_id)]}
+               for hit in hits if (hit.kind, hit.ref_id) in found]
+    response_body["message"] = f"Results for {query} got successfully"
+    response_body["results"] = results
+    return jsonify(response_body), 200
+
+
+@api.route("/batch", methods=["POST"])
+@jwt_required()
+def handle_batch():
+    response_body = {}
+    claims = get_jwt()
+    token_user_id = claims["user_id"]
+    if not token_user_id:
+        response_body["message"] = "Current user not found"
+        response_body["results"] = None
+        return jsonify(response_body), 401
+    data = request.json
+    sub_requests = data.get("requests", None) if isinstance(data, dict) else None
+    max_requests = current_app.config.get("BATCH_MAX_REQUESTS", 50)
+    if not isinstance(sub_requests, list) or not sub_requests or len(sub_requests) > max_requests:
+        response_body["message"] = f"Batch must be a non empty list of at most {max_requests} requests"
+        response_body["results"] = None
+        return jsonify(response_body), 400
+    results = run_batch(sub_requests, bool(data.get("parallel", False)))
+    response_body["message"] = f"Batch of {len(sub_requests)} requests processed"
+    response_body["results"] = results
+    return jsonify(response_body), 200
+
+
+@api.route("/admin/stats", methods=["GET"])
+@jwt_required()
+def handle_admin_stats():
+    response_body = {}
+    claims = get_jwt()
+    token_user_id = claims["user_id"]
+    if not token_user_id:
+        response_body["message"] = "Current user not found"
+        response_body["results"] = None
+        return jsonify(response_body), 401
+    if not claims["is_admin"]:
+        response_body["message"] = f"User {token_user_id} is not allowed to get stats"
+        response_body["results"] = None
+        return jsonify(response_body), 403
+    endpoint_stats = current_app.extensions.get("sql_instrumentation", None)
+    if not endpoint_stats:
+        response_body["message"] = "SQL instrumentation is not enabled"
+        response_body["results"] = None
+        return jsonify(response_body), 404
+    response_body["message"] = "Endpoint stats got successfully"
+    response_body["results"] = endpoint_stats.snapshot()
+    return jsonify(response_body), 200
+
+
+@api.route("/admin/pools", methods=["GET"])
+@jwt_required()
+def handle_admin_pools():
+    response_body = {}
+    claims = get_jwt()
+    token_user_id = claims["user_id"]
+    if not token_user_id:
+        response_body["message"] = "Current user not found"
+        response_body["results"] = None
+        return jsonify(response_body), 401
+    if not claims["is_admin"]:
+        response_body["message"] = f"User {token_user_id} is not allowed to get pools"
+        response_body["results"] = None
+        return jsonify(response_body), 403
+    response_body["message"] = "Connection pools got successfully"
+    response_body["results"] = pool_metrics(db.engines)
+    return jsonify(response_body), 200
+
+
+@api.route("/admin/entity-cache", methods=["GET"])
+@jwt_required()
+def handle_admin_entity_cache():
+    response_body = {}
+    claims = get_jwt()
+    token_user_id = claims["user_id"]
+    if not token_user_id:
+        response_body["message"] = "Current user not found"
+        response_body["results"] = None
+        return jsonify(response_body), 401
+    if not claims["is_admin"]:
+        response_body["message"] = f"User {token_user_id} is not allowed to get the entity cache"
+        response_body["results"] = None
+        return jsonify(response_body), 403
+    response_body["message"] = "Entity cache metrics got successfully"
+    response_body["results"] = get_entity_cache().metrics()
+    return jsonify(response_body), 200
@@ -0,0 +1,101 @@
+"""
+This module takes care of the full-text search over post titles, descriptions and bodies and over comments.
+Documents live in a FTS5 virtual table on SQLite and in a tsvector column with a GIN index on PostgreSQL,
+they are written by the post and comment write paths and can be rebuilt with the reindex-search command.
+The search_documents table is part of db.metadata (see api.models), so it is created with the other tables
+"""
+from sqlalchemy import column, text
+from api.models import db, Posts, Comments, search_documents
+
+
+def get_dialect(session=None):
+    # Asking db.session for its bind would pin the request to the primary (see api.replicas), the replicas
+    # run the same database as the primary engine. Sessions bound to an engine, like the ones of api.asgi,
+    # answer with it
+    bind = session.bind if session is not None else None
+    return (bind if bind is not None else db.engine).dialect.name
+
+
+def index_documents(documents, session=None):
+    # documents are dicts with kind ("post" or "comment"), ref_id, post_id, title and content. Posts and
+    # comments are never edited, so new documents are only appended
+    session = session if session is not None else db.session
+    if not documents:
+        return
+    if get_dialect(session) == "postgresql":
+        statement = text("INSERT INTO search_documents (kind, ref_id, post_id, title, content, document) "
+                         "VALUES (:kind, :ref_id, :post_id, :title, :content, "
+                         "setweight(to_tsvector('english', :title), 'A') || "
+                         "setweight(to_tsvector('english', :content), 'B')) "
+                         "ON CONFLICT (kind, ref_id) DO UPDATE SET title = excluded.title, "
+                         "content = excluded.content, document = excluded.document")
+    else:
+        statement = text("INSERT INTO search_documents (kind, ref_id, post_id, title, content) "
+                         "VALUES (:kind, :ref_id, :post_id, :title, :content)")
+    session.execute(statement, documents)
+
+
+def post_document(post_id, title, description, body):
+    return {"kind": "post",
+            "ref_id": post_id,
+            "post_id": post_id,
+            "title": title or "",
+            "content": " ".join(value for value in [description, body] if value)}
+
+
+def comment_document(comment_id, post_id, body):
+    return {"kind": "comment",
+            "ref_id": comment_id,
+            "post_id": post_id,
+            "title": "",
+            "content": body or ""}
+
+
+def search(query, limit, cursor=None, session=None):
+    # Hits are ranked best first and paginated by (score, kind, ref_id), smaller scores are better on both databases
+    session = session if session is not None else db.session
+    params = {"query": query, "limit": limit + 1}
+    if get_dialect(session) == "postgresql":
+        ranked = ("SELECT kind, ref_id, post_id, "
+                  "-ts_rank_cd(document, websearch_to_tsquery('english', :query)) AS score "
+                  "FROM search_documents WHERE document @@ websearch_to_tsquery('english', :query)")
+    else:
+        params["query"] = to_fts5_query(query)
+        ranked = ("SELECT kind, ref_id, post_id, bm25(search_documents, 0, 0, 0, 10.0, 1.0) AS score "
+                  "FROM search_documents WHERE search_documents MATCH :query")
+    statement = f"SELECT kind, ref_id, post_id, score FROM ({ranked}) AS hits"
+    if cursor:
+        statement += (" WHERE score > :score OR (score = :score AND (kind > :kind OR "
+                      "(kind = :kind AND ref_id > :ref_id)))")
+        params.update(cursor)
+    statement += " ORDER BY score, kind, ref_id LIMIT :limit"
+    # A textual SELECT, so api.replicas sends it to a replica like the other reads
+    statement = text(statement).columns(column("kind"), column("ref_id"), column("post_id"), column("score"))
+    return session.execute(statement, params).all()
+
+
+def to_fts5_query(query):
+    # User input is searched as quoted terms so FTS5 operators in it are not interpreted
+    terms = [term.replace('"', '""') for term in query.split()]
+    return " ".join(f'"{term}"' for term in terms)
+
+
+def reindex_all(batch_size=1000, session=None):
+    session = session if session is not None else db.session
+    search_documents.create(session.connection(), checkfirst=True)
+    session.execute(text("DELETE FROM search_documents"))
+    posts = db.select(Posts.id, Posts.title, Posts.description, Posts.body).order_by(Posts.id)
+    documents = []
+    for row in session.execute(posts.execution_options(yield_per=batch_size)):
+        documents.append(post_document(row.id, row.title, row.description, row.body))
+        if len(documents) >= batch_size:
+            index_documents(documents, session)
+            documents = []
+    comments = db.select(Comments.id, Comments.post_id, Comments.body).order_by(Comments.id)
+    for row in session.execute(comments.execution_options(yield_per=batch_size)):
+        documents.append(comment_document(row.id, row.post_id, row.body))
+        if len(documents) >= batch_size:
+            index_documents(documents, session)
+            documents = []
+    index_documents(documents, session)
+    session.commit()
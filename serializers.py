@@ -0,0 +1,98 @@
+"""
+This module takes care of the sparse fieldsets (?fields=) and selective embedding (?include=) of Users and
+Posts. Each serializer declares its fields and embeds, and the query only loads what was asked for.
+Without parameters the payload is the same as serialize_users and serialize_posts
+"""
+from abc import ABC, abstractmethod
+from sqlalchemy.orm import load_only
+from api.models import db, Users, Posts, load_user_relations, load_post_relations, USER_RELATIONS, POST_RELATIONS
+
+
+def build_claims(user_results):
+    # JWT claims of a serialized user, shared by the sync and async apps
+    return {"user_id": user_results["id"],
+            "email": user_results["email"],
+            "is_active": user_results["is_active"],
+            "is_admin": user_results["is_admin"],
+            "first_name": user_results["first_name"] if user_results["first_name"] else None,
+            "last_name": user_results["last_name"] if user_results["last_name"] else None,
+            "followers": user_results["followers"],
+            "following": user_results["following"],
+            "posts": user_results["posts"],
+            "comments": user_results["comments"]}
+
+
+def split_names(value):
+    if value is None:
+        return None
+    return [name.strip() for name in value.split(",") if name.strip()]
+
+
+class ModelSerializer(ABC):
+    model = None
+    fields = ()
+    includes = ()
+    # Columns always loaded, e.g. the ones used for ordering and cursors
+    required = ("id",)
+    formatters = {}
+
+    def __init__(self, fields=None, include=None):
+        unknown = set(fields or ()) - set(self.fields) | set(include or ()) - set(self.includes)
+        if unknown:
+            raise ValueError(f"Unknown fields {', '.join(sorted(unknown))}")
+        # Asking for some fields only embeds relationships that are explicitly included
+        self.selected_fields = [name for name in self.fields if fields is None or name in fields or name == "id"]
+        if include is None:
+            include = self.includes if fields is None else ()
+        self.selected_includes = [name for name in self.includes if name in include]
+
+    @classmethod
+    def from_args(cls, args, **kwargs):
+        return cls(split_names(args.get("fields", None)), split_names(args.get("include", None)), **kwargs)
+
+    def select(self):
+        columns = dict.fromkeys([*self.required, *self.selected_fields])
+        return db.select(self.model).options(load_only(*[getattr(self.model, name) for name in columns]))
+
+    @abstractmethod
+    def load_relations(self, ids, session):
+        # Returns {include name: {id: embedded value}} for the selected includes
+        pass
+
+    def dump(self, objects, session=None):
+        relations = self.load_relations([row.id for row in objects], session) if self.selected_includes else {}
+        results = []
+        for row in objects:
+            result = {}
+            for name in self.selected_fields:
+                value = getattr(row, name)
+                result[name] = self.formatters[name](value) if name in self.formatters and value is not None else value
+            for name in self.selected_includes:
+                result[name] = relations[name].get(row.id)
+            results.append(result)
+        return results
+
+
+class UserSerializer(ModelSerializer):
+    model = Users
+    fields = ("id", "email", "is_active", "is_admin", "first_name", "last_name",
+              "follower_count", "following_count", "post_count")
+    includes = USER_RELATIONS
+
+    def load_relations(self, ids, session):
+        return load_user_relations(ids, self.selected_includes, session)
+
+
+class PostSerializer(ModelSerializer):
+    model = Posts
+    fields = ("id", "title", "description", "body", "date", "comment_count", "user_id")
+    includes = POST_RELATIONS
+    required = ("id", "date")
+    formatters = {"date": lambda value: value.strftime("%d-%m-%Y")}
+
+    def __init__(self, fields=None, include=None, comments_limit=None):
+        super().__init__(fields, include)
+        self.comments_limit = comments_limit
+
+    def load_relations(self, ids, session):
+        return load_post_relations(ids, self.selected_includes, self.comments_limit, session)
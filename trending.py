@@ -0,0 +1,139 @@
+"""
+This module takes care of the trending posts. The comment and media write paths add their engagement to
+the PostEngagement bucket of the current time in the same transaction, and every worker keeps the decayed
+scores of the last TRENDING_WINDOW buckets with a top-K ranking. A refresh only reloads the open bucket,
+the whole window is scored again once per bucket when the oldest one expires
+"""
+import heapq
+import threading
+import time
+from collections import Counter
+from flask import current_app
+from sqlalchemy import delete
+from api.models import db, PostEngagement, dialect_insert
+
+
+ENGAGEMENT_WEIGHTS = {"comments": 1.0, "media": 3.0}
+
+
+def get_bucket_seconds():
+    return current_app.config.get("TRENDING_BUCKET_SECONDS", 3600)
+
+
+def current_bucket(bucket_seconds):
+    return int(time.time() // bucket_seconds)
+
+
+def record_engagement(post_ids, kind, session=None):
+    # kind is "comments" or "media", every post id counts once per occurrence in one executemany upsert
+    session = session if session is not None else db.session
+    counts = Counter(post_ids)
+    if not counts:
+        return
+    bucket = current_bucket(get_bucket_seconds())
+    table = PostEngagement.__table__
+    statement = dialect_insert(table, session)
+    statement = statement.on_conflict_do_update(index_elements=["post_id", "bucket"],
+                                                set_={kind: table.c[kind] + statement.excluded[kind]})
+    session.connection().execute(statement, [{"post_id": post_id, "bucket": bucket, "comments": 0, "media": 0,
+                                              kind: count} for post_id, count in counts.items()])
+
+
+def prune_engagement(session=None):
+    # Buckets out of the window no longer count, deleting them keeps the table as big as the window
+    session = session if session is not None else db.session
+    window = current_app.config.get("TRENDING_WINDOW", 24)
+    oldest = current_bucket(get_bucket_seconds()) - window + 1
+    deleted = session.execute(delete(PostEngagement).where(PostEngagement.bucket < oldest)).rowcount
+    session.commit()
+    return deleted
+
+
+class TrendingAggregator:
+
+    def __init__(self, bucket_seconds=3600, window=24, decay=0.8, top_k=100, refresh_interval=30):
+        self.bucket_seconds = bucket_seconds
+        self.window = window
+        self.decay = decay
+        self.top_k = top_k
+        self.refresh_interval = refresh_interval
+        self.buckets = {}
+        self.scores = Counter()
+        self.ranking = []
+        self.current = None
+        self.refreshed_at = None
+        self.lock = threading.Lock()
+
+    def get_ranking(self, session=None):
+        # [(post_id, score)] best first, at most top_k
+        self.refresh(session)
+        return self.ranking
+
+    def refresh(self, session=None, force=False):
+        session = session if session is not None else db.session
+        with self.lock:
+            if (not force and self.refreshed_at is not None
+                    and self.refreshed_at + self.refresh_interval > time.monotonic()):
+                return
+            current = current_bucket(self.bucket_seconds)
+            oldest = current - self.window + 1
+            # The bucket that was open at the last refresh may have grown, older ones are final
+            start = oldest if self.current is None else max(oldest, self.current)
+            loaded = {}
+            rows = session.execute(
+                db.select(PostEngagement.post_id, PostEngagement.bucket,
+                          PostEngagement.comments, PostEngagement.media)
+                .where(PostEngagement.bucket >= start)).all()
+            for row in rows:
+                loaded.setdefault(row.bucket, {})[row.post_id] = (row.comments * ENGAGEMENT_WEIGHTS["comments"] +
+                                                                  row.media * ENGAGEMENT_WEIGHTS["media"])
+            if current != self.current:
+                self.rebuild(current, oldest, start, loaded)
+            else:
+                self.update(current, loaded)
+            self.refreshed_at = time.monotonic()
+
+    def weight(self, current, bucket):
+        return self.decay ** max(current - bucket, 0)
+
+    def rebuild(self, current, oldest, start, loaded):
+        # Every weight changes when the open bucket moves, so the window is scored again
+        for bucket in list(self.buckets):
+            if bucket < oldest or bucket >= start:
+                del self.buckets[bucket]
+        self.buckets.update(loaded)
+        self.scores = Counter()
+        for bucket, posts in self.buckets.items():
+            weight = self.weight(current, bucket)
+            for post_id, score in posts.items():
+                self.scores[post_id] += score * weight
+        self.ranking = heapq.nlargest(self.top_k, self.scores.items(), key=lambda item: (item[1], item[0]))
+        self.current = current
+
+    def update(self, current, loaded):
+        # Engagement only grows inside the open bucket, so the new top-K comes from the old one and the changes
+        changed = set()
+        for bucket, posts in loaded.items():
+            previous = self.buckets.get(bucket, {})
+            weight = self.weight(current, bucket)
+            for post_id, score in posts.items():
+                delta = score - previous.get(post_id, 0)
+                if delta:
+                    self.scores[post_id] += delta * weight
+                    changed.add(post_id)
+            self.buckets[bucket] = posts
+        if changed:
+            candidates = changed.union(post_id for post_id, score in self.ranking)
+            self.ranking = heapq.nlargest(self.top_k, ((post_id, self.scores[post_id]) for post_id in candidates),
+                                          key=lambda item: (item[1], item[0]))
+
+
+def get_trending():
+    if "trending" not in current_app.extensions:
+        current_app.extensions["trending"] = TrendingAggregator(
+            get_bucket_seconds(),
+            current_app.config.get("TRENDING_WINDOW", 24),
+            current_app.config.get("TRENDING_DECAY", 0.8),
+            current_app.config.get("TRENDING_TOP_K", 100),
+            current_app.config.get("TRENDING_REFRESH_INTERVAL", 30))
+    return current_app.extensions["trending"]